@@ -26,7 +26,7 @@ import yaml
 from bottle import Bottle, request, response, template, static_file
 from subprocess import call
 
-from ybd import app
+from ybd import app, utils
 
 bottle = Bottle()
 
@@ -91,7 +91,11 @@ class KeyedBinaryArtifactServer(object):
         path = os.path.join(app.config['artifact-dir'], f)
         if os.path.exists(path):
             call(['touch', os.path.dirname(path)])
-        return static_file(f, root=app.config['artifact-dir'], download=True)
+        result = static_file(f, root=app.config['artifact-dir'], download=True)
+        if os.path.exists(path):
+            # let clients know how the artifact is compressed
+            result.set_header('X-Artifact-Codec', utils.detect_codec(path))
+        return result
 
     @bottle.get('/')
     @bottle.get('/status')
@@ -128,7 +132,7 @@ class KeyedBinaryArtifactServer(object):
             upload.save(artifact)
             unpackdir = artifact + '.unpacked'
             os.makedirs(unpackdir)
-            if call(['tar', 'xf', artifact, '--directory', unpackdir]):
+            if not utils.unpack_archive(artifact, unpackdir):
                 app.log(this, 'ERROR: Problem unpacking', artifact)
                 raise
             shutil.rmtree(unpackdir)
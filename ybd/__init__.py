@@ -21,5 +21,6 @@ import definitions
 import deployment
 import repos
 import sandbox
+import scheduler
 import utils
 import wrangler
@@ -21,11 +21,13 @@ import os
 import sys
 import fcntl
 import app
-from assembly import compose, RetryException
+from assembly import compose, wait, RetryException
 from deployment import deploy
 from definitions import Definitions
 import cache
+import repos
 import sandbox
+import scheduler
 import sandboxlib
 
 
@@ -36,7 +38,6 @@ if not os.path.exists('./VERSION'):
             os.chdir(os.path.join(os.getcwd(), 'definitions'))
 app.setup(sys.argv)
 app.cleanup(app.config['tmp'])
-app.cull(app.config['artifacts'])
 
 with app.timer('TOTAL'):
     tmp_lock = open(os.path.join(app.config['tmp'], 'lock'), 'r')
@@ -46,9 +47,16 @@ with app.timer('TOTAL'):
     app.log('TARGET', 'Target is %s' % target, app.config['arch'])
     with app.timer('DEFINITIONS', 'parsing %s' % app.config['def-version']):
         defs = Definitions()
+    repos.prefetch([d for d in defs.components(app.config['target'])
+                    if not cache.is_cached(cache.lookup_key(defs, d))])
     with app.timer('CACHE-KEYS', 'cache-key calculations'):
+        repos.get_trees([d for d in defs.components(app.config['target'])
+                         if cache.lookup_key(defs, d) is None])
         cache.cache_key(defs, app.config['target'])
     defs.save_trees()
+    app.cull(app.config['artifacts'],
+             [cache.cache_key(defs, d)
+              for d in defs.components(app.config['target'])])
 
     sandbox.executor = sandboxlib.executor_for_platform()
     app.log(app.config['target'], 'Sandbox using %s' % sandbox.executor)
@@ -56,10 +64,14 @@ with app.timer('TOTAL'):
         app.log(app.config['target'], 'WARNING: using chroot is less safe ' +
                 'than using linux-user-chroot')
 
-    if app.config.get('instances'):
-        app.spawn()
-
     target = defs.get(app.config['target'])
+    try:
+        # even on one worker, for the ETA as it goes
+        scheduler.build(defs, target)
+    except KeyboardInterrupt:
+        app.log(target, 'Interrupted by user')
+        os._exit(1)
+
     while True:
         try:
             compose(defs, target)
@@ -67,8 +79,8 @@ with app.timer('TOTAL'):
         except KeyboardInterrupt:
             app.log(target, 'Interrupted by user')
             os._exit(1)
-        except RetryException:
-            pass
+        except RetryException as e:
+            wait(defs, e.component)
         except:
             import traceback
             traceback.print_exc()
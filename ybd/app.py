@@ -22,7 +22,7 @@ import shutil
 import sys
 import warnings
 import yaml
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Array, Value
 from subprocess import call, check_output
 import platform
 from repos import get_version
@@ -32,21 +32,38 @@ config = {}
 
 
 class Counter(object):
-    def __init__(self, pid):
-        self._counter_file = os.path.join(config['tmp'], str(pid))
-        with open(self._counter_file, 'a') as f:
-            f.write(str(0))
+    '''Progress counters shared by all instances, in shared memory.
+
+    This must be created before forking any workers, so they all share it.
+    Updates are atomic, and reading doesn't need any I/O so it's cheap to
+    do for every log line.
+
+    '''
+    def __init__(self, instances=1):
+        self._count = Value('l', 0)
+        self._current = Array('c', 64 * instances)
 
     def increment(self):
-        with open(self._counter_file, 'r') as f:
-            count = f.read()
-        with open(self._counter_file, 'w') as f:
-            f.write(str(int(count) + 1))
+        with self._count.get_lock():
+            self._count.value += 1
 
     def get(self):
-        with open(self._counter_file, 'r') as f:
-            count = f.read()
-        return count
+        return self._count.get_obj().value
+
+    def set_current(self, component, fork=None):
+        '''Record what this instance (or the given fork) is working on.'''
+        name = component['name'] if type(component) is dict else component
+        if fork is None:
+            fork = config.get('fork', 0)
+        start = fork * 64
+        with self._current.get_lock():
+            self._current[start:start + 64] = name[:63].ljust(64, '\0')
+
+    def current(self):
+        '''Return what each instance is working on.'''
+        names = self._current.get_obj().raw
+        return [names[i:i + 64].rstrip('\0') for i in
+                range(0, len(names), 64)]
 
 
 def log(component, message='', data=''):
@@ -61,6 +78,11 @@ def log(component, message='', data=''):
     if config.get('counter'):
         count = config['counter'].get()
         progress = '[%s/%s/%s] ' % (count, config['tasks'], config['total'])
+        if config.get('instances', 1) > 1 and config.get('fork') is None:
+            # the main instance shows what all the workers are building
+            busy = [it for it in config['counter'].current() if it]
+            if busy:
+                progress += '(%s) ' % ', '.join(busy)
     entry = '%s %s[%s] %s %s\n' % (timestamp, progress, name, message, data)
     if config.get('instances'):
         entry = str(config.get('fork', 0)) + ' ' + entry
@@ -149,10 +171,12 @@ def setup(args):
     os.environ['GIT_NO_REPLACE_OBJECTS'] = '1'
 
     if not config.get('max-jobs'):
-        config['max-jobs'] = cpu_count() / config.get('instances', 1)
+        config['max-jobs'] = cpu_count()
+        if not config.get('jobserver'):
+            config['max-jobs'] = jobs()
 
     config['pid'] = os.getpid()
-    config['counter'] = Counter(config['pid'])
+    config['counter'] = Counter(config.get('instances', 1) + 1)
     log('SETUP', '%s version is' % config['program'], config['my-version'])
     log('SETUP', 'Max-jobs is set to', config['max-jobs'])
 
@@ -173,43 +197,78 @@ def cleanup(tmpdir):
     try:
         with open(os.path.join(tmpdir, 'lock'), 'w') as tmp_lock:
             fcntl.flock(tmp_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            to_delete = os.listdir(tmpdir)
+            to_delete = [f for f in os.listdir(tmpdir) if f != 'jobserver']
+            jobserver(tmpdir, fresh=True)
             fcntl.flock(tmp_lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
             if os.fork() == 0:
                 for dirname in to_delete:
                     remove_dir(os.path.join(tmpdir, dirname))
                 log('SETUP', 'Cleanup successful for', tmpdir)
                 sys.exit(0)
-    except IOError:
+    except (IOError, OSError):
         log('SETUP', 'No cleanup for', tmpdir)
+        jobserver(tmpdir)
+
 
+def jobserver(tmpdir, fresh=False):
+    '''Join the GNU make jobserver shared by every ybd working in tmpdir.
 
-def sorted_ls(path):
-    mtime = lambda f: os.stat(os.path.join(path, f)).st_mtime
-    return list(sorted(os.listdir(path), key=mtime))
-
-
-def cull(artifact_dir):
-    deleted = 0
-    artifacts = sorted_ls(artifact_dir)
-    stat = os.statvfs(artifact_dir)
-    free = stat.f_frsize * stat.f_bavail / 1000000000
-    for artifact in artifacts:
-        stat = os.statvfs(artifact_dir)
-        free = stat.f_frsize * stat.f_bavail / 1000000000
-        if free > config.get('min-gigabytes', 10):
-            log('SETUP', '%sGB is enough free space' % free)
-            if deleted > 0:
-                log('SETUP', 'Culled %s artifacts in' % deleted, artifact_dir)
-            return
-        path = os.path.join(artifact_dir, artifact)
-        if os.path.isdir(path):
-            shutil.rmtree(path)
-        else:
-            os.remove(path)
-        deleted += 1
-    if free < config.get('min-gigabytes', 10):
-        log('SETUP', 'ERROR: %s is less than min-gigabytes' % free)
+    The jobserver is a fifo holding one token for each job that may run on
+    top of the one every build gets for free, so that however many builds
+    are running, and whether they're serial configures or parallel makes,
+    'max-jobs' jobs run in total. The first ybd creates and fills it; each
+    ybd keeps it open while running, because a fifo loses its contents
+    when nothing has it open. If we can't join it, each build gets its share
+    of 'max-jobs' as it would without a jobserver.
+
+    '''
+    if not config.get('jobserver'):
+        return
+    path = os.path.join(tmpdir, 'jobserver')
+    try:
+        if fresh:
+            if os.path.exists(path):
+                os.remove(path)
+            os.mkfifo(path)
+        elif not os.path.exists(path):
+            raise OSError('no jobserver found')
+        fd = os.open(path, os.O_RDWR)
+        if fresh:
+            tokens = max(config['max-jobs'] - config.get('instances', 1), 0)
+            os.write(fd, '+' * tokens)
+            log('SETUP', 'Jobserver started with %s tokens at' % tokens, path)
+    except OSError as e:
+        log('SETUP', 'WARNING: no jobserver in %s:' % tmpdir, e)
+        config['max-jobs'] = jobs()
+        return
+
+    config['jobserver-fifo'] = path
+    config['jobserver-fd'] = fd
+
+
+def jobs():
+    '''Return each instance's share of 'max-jobs'.'''
+    return max(1, config['max-jobs'] / config.get('instances', 1))
+
+
+def cull(artifact_dir, keep=[]):
+    '''Free up space in artifact_dir, in the background.
+
+    Artifacts whose cache keys are in keep (eg everything needed for the
+    current target) are never deleted.
+
+    '''
+    if os.fork() == 0:
+        import cache
+        try:
+            cache.evict(artifact_dir, keep)
+            cache.cull_objects()
+            cache.cull_sources()
+        except:
+            import traceback
+            traceback.print_exc()
+            log('SETUP', 'WARNING: problem culling', artifact_dir)
+        os._exit(0)
 
 
 def remove_dir(tmpdir):
@@ -253,10 +312,3 @@ def elapsed(starttime):
     minutes, seconds = divmod(remainder, 60)
     return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
-
-def spawn():
-    for fork in range(1, config.get('instances')):
-        if os.fork() == 0:
-            config['fork'] = fork
-            log('FORKS', 'I am fork', config.get('fork'))
-            break
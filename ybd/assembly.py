@@ -15,38 +15,29 @@
 # =*= License: GPL-2 =*=
 
 import os
-import random
-from subprocess import call, check_output
 import contextlib
 import fcntl
 
 import json
 import app
-from cache import cache, cache_key, get_cache, get_remote
+from cache import cache, cache_key, get_cache, get_remote, record_duration
 import repos
 import sandbox
-from shutil import copyfile
 import time
 import datetime
 
 
 class RetryException(Exception):
+    '''Raised when another ybd holds the claim on a component we need.
+
+    Nothing has been staged for the component yet, so the caller can get
+    on with something else and come back to it when wait() returns.
+
+    '''
     def __init__(self, defs, component):
-        if app.config['log-verbose'] and \
-                app.config.get('last-retry-component') != component:
+        if app.config['log-verbose']:
             app.log(component, 'Already downloading/building, so wait/retry')
-        if app.config.get('last-retry'):
-            wait = datetime.datetime.now() - app.config.get('last-retry')
-            if wait.seconds < 1:
-                with open(lockfile(defs, component), 'r') as l:
-                    call(['flock', '--shared', '--timeout',
-                          app.config.get('timeout', '60'), str(l.fileno())])
-        app.config['last-retry'] = datetime.datetime.now()
-        app.config['last-retry-component'] = component
-        for dirname in app.config['sandboxes']:
-            app.remove_dir(dirname)
-        app.config['sandboxes'] = []
-        pass
+        self.component = component
 
 
 def compose(defs, target):
@@ -64,21 +55,26 @@ def compose(defs, target):
     if get_cache(defs, component):
         return cache_key(defs, component)
 
-    # if we have a kbas, look there to see if this component exists
-    if app.config.get('kbas-url'):
-        with claim(defs, component):
+    with claim(defs, component):
+        # another ybd may have finished it while we waited for the claim
+        if get_cache(defs, component):
+            return cache_key(defs, component)
+
+        # if we have a kbas, look there to see if this component exists
+        if app.config.get('kbas-url'):
             if get_remote(defs, component):
                 app.config['counter'].increment()
                 return cache_key(defs, component)
 
-    if component.get('arch') and component['arch'] != app.config['arch']:
-        return None
+        if component.get('arch') and component['arch'] != app.config['arch']:
+            return None
 
-    with sandbox.setup(component):
-        assemble(defs, component)
-        if 'systems' not in component and not get_cache(defs, component):
-            install_dependencies(defs, component)
-            build(defs, component)
+        with sandbox.setup(component):
+            assemble(defs, component)
+            if 'systems' not in component and \
+                    not get_cache(defs, component):
+                install_dependencies(defs, component)
+                build(defs, component)
 
     return cache_key(defs, component)
 
@@ -86,7 +82,6 @@ def compose(defs, target):
 def assemble(defs, component):
     '''Handle creation of composite components (strata, systems, clusters)'''
     systems = component.get('systems', [])
-    shuffle(systems)
     for system in systems:
         compose(defs, system['path'])
         for subsystem in system.get('subsystems', []):
@@ -98,14 +93,14 @@ def assemble(defs, component):
 def build(defs, component):
     '''Create an artifact for a single component and add it to the cache'''
 
-    with claim(defs, component):
-        app.config['counter'].increment()
-        with app.timer(component, 'build of %s' % component['cache']):
-            run_build(defs, component)
+    app.config['counter'].increment()
+    app.config['counter'].set_current(component)
+    with app.timer(component, 'build of %s' % component['cache']):
+        run_build(defs, component)
+    sandbox.unmount(component)
 
-        with app.timer(component, 'artifact creation'):
-            do_manifest(component)
-            cache(defs, component)
+    with app.timer(component, 'artifact creation'):
+        cache(defs, component)
 
 
 def run_build(defs, this):
@@ -122,11 +117,10 @@ def run_build(defs, this):
                 os.path.join(app.config['tmp'], this['name']))
         return
 
-    if this.get('build-mode') != 'bootstrap':
-        sandbox.ldconfig(this)
-
     if this.get('repo'):
-        repos.checkout(this['name'], this['repo'], this['ref'], this['build'])
+        this['submodules'] = repos.checkout(this['name'], this['repo'],
+                                            this['ref'], this['build'],
+                                            this.get('tree'))
 
     get_build_commands(defs, this)
     env_vars = sandbox.env_vars_for_build(defs, this)
@@ -149,12 +143,8 @@ def run_build(defs, this):
 
     with open(this['log'], "a") as logfile:
         logfile.write('Elapsed_time: %s\n' % app.elapsed(this['start-time']))
-
-
-def shuffle(contents):
-    if app.config.get('instances', 1) > 1:
-        random.seed(datetime.datetime.now())
-        random.shuffle(contents)
+    elapsed = datetime.datetime.now() - this['start-time']
+    record_duration(this['name'].replace('/', '-'), elapsed.total_seconds())
 
 
 def lockfile(defs, this):
@@ -163,32 +153,38 @@ def lockfile(defs, this):
 
 @contextlib.contextmanager
 def claim(defs, this):
-    # take a lock so we don't race building 'this'
-    # FIXME: we should claim always, but the claim code is eating exceptions
-    # so currently we only claim on multi-instance so it's easier to debug
-    # on single instance runs
-    if app.config.get('instances', 1) > 1:
-        try:
-            with open(lockfile(defs, this), 'a') as l:
+    '''Take the claim on building this, so we don't race other ybds for it.
+
+    The claim is a lock on this's lockfile, held until its artifact is in
+    the cache. If someone else holds it and we have nothing staged yet, we
+    raise RetryException. If we're already part way through staging a
+    sandbox we wait for them to finish rather than throw the sandbox away,
+    so the caller needs to check the cache again once it has the claim.
+
+    '''
+    with open(lockfile(defs, this), 'a') as l:
+        while True:
+            try:
                 fcntl.flock(l, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                try:
-                    yield
-                finally:
-                    return
-        except IOError as e:
-            raise RetryException(defs, this)
-    else:
-        try:
-            yield
-        finally:
-            return
+                break
+            except IOError:
+                if not app.config.get('sandboxes'):
+                    raise RetryException(defs, this)
+                app.log(this, 'Waiting for another ybd to finish')
+                wait(defs, this)
+        yield
+
+
+def wait(defs, this):
+    '''Block until nobody holds the claim on this.'''
+    with open(lockfile(defs, this), 'a') as l:
+        fcntl.flock(l, fcntl.LOCK_SH)
 
 
 def install_contents(defs, component):
     '''Install recursed contents of component into component's sandbox.'''
 
     def install(defs, component, contents):
-        shuffle(contents)
         for it in contents:
             content = defs.get(it)
             if os.path.exists(os.path.join(component['sandbox'], 'baserock',
@@ -212,14 +208,19 @@ def install_contents(defs, component):
 
 
 def install_dependencies(defs, component):
-    '''Install recursed dependencies of component into component's sandbox.'''
+    '''Install recursed dependencies of component into component's sandbox.
+
+    Chunks with the same dependencies and build-mode get the same staging,
+    so the first one saves a snapshot of its sandbox (after ldconfig) and
+    the others are staged by cloning it. With overlayfs staging there's no
+    need, since the dependencies are mounted rather than linked.
+
+    '''
 
     def install(defs, component, dependencies):
-        shuffle(dependencies)
         for it in dependencies:
             dependency = defs.get(it)
-            if os.path.exists(os.path.join(component['sandbox'], 'baserock',
-                                           dependency['name'] + '.meta')):
+            if sandbox.installed(component, dependency):
                 # dependency has already been installed
                 if app.config.get('log-verbose'):
                     app.log(component, 'Already installed', dependency['name'])
@@ -238,11 +239,42 @@ def install_dependencies(defs, component):
     dependencies = component.get('build-depends', [])
     if app.config.get('log-verbose'):
         app.log(component, 'Installing dependencies\n', dependencies)
-    install(defs, component, dependencies)
+    snapshot = None
+    if not (component.get('contents') or sandbox.overlay(component)):
+        snapshot = sandbox.snapshot_key(defs, component,
+                                        staged(defs, component))
+    if not (snapshot and sandbox.restore(component, snapshot)):
+        install(defs, component, dependencies)
+        sandbox.mount(component)
+        if component.get('build-mode') != 'bootstrap':
+            sandbox.ldconfig(component)
+        if snapshot:
+            sandbox.snapshot(component, snapshot)
     if app.config.get('log-verbose'):
         sandbox.list_files(component)
 
 
+def staged(defs, component):
+    '''Return what install_dependencies() installs for component, in order.'''
+    result = []
+
+    def install(dependencies):
+        for it in dependencies:
+            dependency = defs.get(it)
+            if dependency['path'] in [d['path'] for d in result]:
+                continue
+
+            install(dependency.get('build-depends', []))
+            if (it in component['build-depends']) or \
+                (dependency.get('build-mode', 'staging') ==
+                    component.get('build-mode', 'staging')):
+                install(dependency.get('contents', []))
+                result.append(dependency)
+
+    install(component.get('build-depends', []))
+    return result
+
+
 def get_build_commands(defs, this):
     '''Get commands specified in 'this', plus commands implied by build-system
 
@@ -301,12 +333,3 @@ def gather_integration_commands(defs, this):
         result.extend(all_commands[key])
     return result
 
-
-def do_manifest(this):
-    metafile = os.path.join(this['baserockdir'], this['name'] + '.meta')
-    with app.chdir(this['install']), open(metafile, "w") as f:
-        f.write("repo: %s\nref: %s\n" % (this.get('repo'), this.get('ref')))
-        f.flush()
-        call(['find'], stdout=f, stderr=f)
-    copyfile(metafile, os.path.join(app.config['artifacts'],
-                                    this['cache'] + '.meta'))
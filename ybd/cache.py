@@ -16,12 +16,19 @@
 
 import requests
 
+import contextlib
+import errno
+import fcntl
 import hashlib
 import json
 import os
+import re
 import shutil
+import sqlite3
+import stat
 import sys
-from subprocess import call
+import threading
+import time
 
 import app
 import repos
@@ -29,6 +36,8 @@ import utils
 import tempfile
 
 cache_list = {}
+digests = {}
+index = threading.local()
 
 
 def cache_key(defs, this):
@@ -47,9 +56,6 @@ def cache_key(defs, this):
 
     definition['cache'] = 'calculating'
 
-    if definition.get('repo') and not definition.get('tree'):
-        definition['tree'] = repos.get_tree(definition)
-
     hash_factors = {'arch': app.config['arch']}
 
     for factor in definition.get('build-depends', []):
@@ -58,7 +64,7 @@ def cache_key(defs, this):
     for factor in definition.get('contents', []):
         hash_factors[factor] = cache_key(defs, factor)
 
-    for factor in ['tree'] + defs.defaults.build_steps:
+    for factor in defs.defaults.build_steps:
         if definition.get(factor):
             hash_factors[factor] = definition[factor]
 
@@ -72,12 +78,24 @@ def cache_key(defs, this):
         for system in definition.get('systems', []):
             hash_system_recursively(system)
 
-    result = json.dumps(hash_factors, sort_keys=True).encode('utf-8')
-
-    safename = definition['name'].replace('/', '-')
-    definition['cache'] = safename + "." + hashlib.sha256(result).hexdigest()
+    key = lookup_key(defs, definition)
+    if key is None:
+        if definition.get('repo') and not definition.get('tree'):
+            definition['tree'] = repos.get_tree(definition)
+        if definition.get('tree'):
+            hash_factors['tree'] = definition['tree']
+
+        result = json.dumps(hash_factors, sort_keys=True).encode('utf-8')
+        safename = definition['name'].replace('/', '-')
+        key = safename + "." + hashlib.sha256(result).hexdigest()
+        if get_digest(defs, definition):
+            query('INSERT OR REPLACE INTO keys VALUES (?, ?)',
+                  get_digest(defs, definition), key)
+
+    definition['cache'] = key
     app.config['total'] += 1
-    if not get_cache(defs, this) and definition.get('kind') != 'cluster':
+    if not is_cached(key) and not get_cache(defs, this) \
+            and definition.get('kind') != 'cluster':
         app.config['tasks'] += 1
     app.log(definition, 'Cache_key is', definition['cache'])
 
@@ -93,6 +111,181 @@ def cache_key(defs, this):
     return definition['cache']
 
 
+def get_digest(defs, this):
+    '''Return a hash of this definition as written, with refs not trees.
+
+    This only depends on the definitions themselves, so it can be calculated
+    without touching git. It stands in for the cache key in the index, so we
+    only provide one if every ref in the subgraph is a full sha1 - anything
+    else (eg a branch name) could move without the definitions changing.
+
+    '''
+    definition = defs.get(this)
+    if definition['path'] in digests:
+        return digests[definition['path']]
+    digests[definition['path']] = None
+
+    hash_factors = {'arch': app.config['arch']}
+    components = (definition.get('build-depends', []) +
+                  definition.get('contents', []))
+
+    def add_systems_recursively(system):
+        components.append(system.get('path', 'BROKEN'))
+        for subsystem in system.get('subsystems', []):
+            add_systems_recursively(subsystem)
+
+    for system in definition.get('systems', []):
+        add_systems_recursively(system)
+
+    for factor in components:
+        if defs.get(factor) is None:
+            return None
+        hash_factors[factor] = get_digest(defs, factor)
+        if hash_factors[factor] is None:
+            return None
+
+    if definition.get('repo') and \
+            not re.match('^[0-9a-f]{40}$', str(definition.get('ref'))):
+        return None
+
+    for factor in ['name', 'repo', 'ref'] + defs.defaults.build_steps:
+        if definition.get(factor):
+            hash_factors[factor] = definition[factor]
+    hash_factors['definition-arch'] = definition.get('arch')
+
+    result = json.dumps(hash_factors, sort_keys=True).encode('utf-8')
+    digests[definition['path']] = hashlib.sha256(result).hexdigest()
+    return digests[definition['path']]
+
+
+def lookup_key(defs, this):
+    '''Return the cache key for this from the index, if it is there.'''
+    digest = get_digest(defs, this)
+    if digest is None:
+        return None
+    result = query('SELECT cache FROM keys WHERE digest = ?', digest)
+    return str(result[0]) if result else None
+
+
+def is_cached(key):
+    '''True if the index says the artifact for key is in the cache.'''
+    return query('SELECT cache FROM artifacts WHERE cache = ?',
+                 key) is not None
+
+
+def record(key, size=None, used=None):
+    '''Note in the index that the artifact for key was used, by default now.'''
+    used = used or time.time()
+    if size is None:
+        query('INSERT OR IGNORE INTO artifacts VALUES (?, NULL, NULL)', key)
+        query('UPDATE artifacts SET used = ? WHERE cache = ?', used, key)
+    else:
+        query('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)', key, size,
+              used)
+
+
+def record_source(name, path):
+    '''Note in the index that the source cache entry name was just used.'''
+    if query('SELECT size FROM sources WHERE name = ?', name):
+        query('UPDATE sources SET used = ? WHERE name = ?', time.time(), name)
+    else:
+        query('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', name,
+              utils.directory_size(path), time.time())
+
+
+def record_duration(name, seconds):
+    '''Add a build time for the named component to its history.'''
+    previous = query('SELECT seconds FROM durations WHERE name = ?', name)
+    if previous:
+        seconds = (seconds + previous[0]) / 2
+    query('INSERT OR REPLACE INTO durations VALUES (?, ?)', name, seconds)
+
+
+def get_durations():
+    '''Return a dict of expected build time in seconds, by component name.
+
+    This comes from the history in the index, and for components which
+    aren't in there yet, from the Elapsed_time at the end of their latest
+    build log in the artifacts directory.
+
+    '''
+    try:
+        durations = dict(get_index().execute(
+            'SELECT name, seconds FROM durations').fetchall())
+    except sqlite3.Error:
+        durations = {}
+
+    logs = {}
+    for name in os.listdir(app.config['artifacts']):
+        match = re.match('^(.*)\.[0-9a-f]{64}\.build-log', name)
+        if match and match.group(1) not in durations:
+            path = os.path.join(app.config['artifacts'], name)
+            if os.path.getmtime(path) > logs.get(match.group(1), (0,))[0]:
+                logs[match.group(1)] = (os.path.getmtime(path), path)
+
+    for name, (mtime, path) in logs.items():
+        with open(path) as f:
+            lines = f.read().splitlines()
+        if lines and lines[-1].startswith('Elapsed_time: '):
+            hours, minutes, seconds = lines[-1].split()[-1].split(':')
+            durations[name] = int(hours) * 3600 + int(minutes) * 60 + \
+                int(seconds)
+            record_duration(name, durations[name])
+
+    return durations
+
+
+def forget(key):
+    '''Drop an artifact from the index, eg because it has been culled.'''
+    query('DELETE FROM artifacts WHERE cache = ?', key)
+    query('DELETE FROM unpacked WHERE cache = ?', key)
+
+
+def get_index():
+    '''Return a connection to the persistent cache-key index.
+
+    The index maps definition digests to cache keys, tracks the size and
+    last use of the artifacts we know to be in the artifacts directory, of
+    their unpacked trees and of the source cache entries, and keeps a
+    history of how long each component takes to build and each git fetch
+    took. Each thread of each process (including forks) gets its own
+    connection, since sqlite won't share one between threads.
+
+    '''
+    if getattr(index, 'pid', None) != os.getpid():
+        db = sqlite3.connect(os.path.join(app.config['base'], 'index.db'),
+                             timeout=60, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS keys '
+                   '(digest TEXT PRIMARY KEY, cache TEXT)')
+        columns = db.execute('PRAGMA table_info(artifacts)').fetchall()
+        if columns and 'used' not in [column[1] for column in columns]:
+            # from before we tracked size and use, so start it again
+            db.execute('DROP TABLE artifacts')
+        db.execute('CREATE TABLE IF NOT EXISTS artifacts '
+                   '(cache TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS unpacked '
+                   '(cache TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS durations '
+                   '(name TEXT PRIMARY KEY, seconds REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS fetches '
+                   '(mirror TEXT, mode TEXT, seconds REAL, time REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS sources '
+                   '(name TEXT PRIMARY KEY, size INTEGER, used REAL)')
+        index.pid = os.getpid()
+        index.db = db
+    return index.db
+
+
+def query(sql, *args):
+    try:
+        return get_index().execute(sql, args).fetchone()
+    except sqlite3.Error as e:
+        app.log('INDEX', 'WARNING: problem with index:', e)
+        return None
+
+
 def cache(defs, this):
     if get_cache(defs, this):
         app.log(this, "Bah! I could have cached", cache_key(defs, this))
@@ -100,19 +293,29 @@ def cache(defs, this):
     tempfile.tempdir = app.config['tmp']
     tmpdir = tempfile.mkdtemp()
     cachefile = os.path.join(tmpdir, cache_key(defs, this))
-    if this.get('kind') == "system":
+    kind = this.get('kind', 'chunk')
+    codec = app.config.get('compression', {}).get(kind, 'gzip')
+    if kind == "system":
         utils.hardlink_all_files(this['install'], this['sandbox'])
         shutil.rmtree(this['install'])
         shutil.rmtree(this['build'])
-        utils.set_mtime_recursively(this['sandbox'])
-        utils.make_deterministic_tar_archive(cachefile, this['sandbox'])
-        os.rename('%s.tar' % cachefile, cachefile)
+        root = this['sandbox']
     else:
-        utils.set_mtime_recursively(this['install'])
-        utils.make_deterministic_gztar_archive(cachefile, this['install'])
-        os.rename('%s.tar.gz' % cachefile, cachefile)
-
-    unpack(defs, this, cachefile)
+        root = this['install']
+
+    metafile = os.path.join('baserock', this['name'] + '.meta')
+    codec, manifest = utils.make_deterministic_archive(
+        cachefile, root, codec,
+        trailer=(metafile, lambda manifest: do_manifest(this, manifest)))
+    shutil.copyfile(os.path.join(root, metafile),
+                    os.path.join(app.config['artifacts'],
+                                 this['cache'] + '.meta'))
+    utils.write_manifest(cachefile + '.manifest', manifest)
+    if app.config.get('log-verbose'):
+        app.log(this, 'Artifact compression is', codec)
+
+    promote(defs, this, cachefile, root,
+            sum([entry[3] for entry in manifest]))
 
     if app.config.get('kbas-password', 'insecure') != 'insecure' and \
             app.config.get('kbas-url', 'http://foo.bar/') != 'http://foo.bar/':
@@ -121,22 +324,66 @@ def cache(defs, this):
                 upload(defs, this)
 
 
+def do_manifest(this, manifest):
+    '''Return the text of the .meta file for this, listing its contents.'''
+    text = "repo: %s\nref: %s\n" % (this.get('repo'), this.get('ref'))
+    for path, url, commit in this.get('submodules', []):
+        text += "submodule: %s %s %s\n" % (path, url, commit)
+    for path, kind, mode, size, digest, linkname, rdev in manifest:
+        text += '%s %s\n' % (path, digest) if digest else path + '\n'
+    return text
+
+
+def promote(defs, this, tmpfile, root, size):
+    '''Use the tree we just archived as the unpacked form of the artifact.
+
+    This saves writing the whole tree out again by unpacking the archive.
+    The files have to look the same as unpacked ones would, so store() sets
+    their timestamps to match the archive as it goes. (Directories and
+    symlinks are made afresh when staging, so theirs don't matter.) If the
+    tree can't be moved, fall back to unpacking.
+
+    '''
+    unpackdir = tmpfile + '.unpacked'
+    try:
+        os.rename(root, unpackdir)
+    except OSError:
+        return unpack(defs, this, tmpfile)
+
+    store(this, unpackdir, get_manifest(tmpfile),
+          utils.default_magic_timestamp)
+    return add_to_cache(defs, this, tmpfile, size)
+
+
 def unpack(defs, this, tmpfile):
     unpackdir = tmpfile + '.unpacked'
     os.makedirs(unpackdir)
-    if call(['tar', 'xf', tmpfile, '--directory', unpackdir]):
+    if not utils.unpack_archive(tmpfile, unpackdir):
         app.log(this, 'Problem unpacking', tmpfile)
         shutil.rmtree(os.path.dirname(tmpfile))
         return False
+    store(this, unpackdir, get_manifest(tmpfile))
+    return add_to_cache(defs, this, tmpfile)
+
 
+def add_to_cache(defs, this, tmpfile, size=None):
+    '''Move the directory holding an artifact and its unpacked tree into the
+    artifacts directory, in one atomic rename.'''
+    if size is None:
+        size = utils.directory_size(tmpfile + '.unpacked')
     try:
         path = os.path.join(app.config['artifacts'], cache_key(defs, this))
         os.rename(os.path.dirname(tmpfile), path)
         if not os.path.isdir(path):
             app.exit(this, 'ERROR: problem creating cache artifact', path)
 
-        size = os.path.getsize(get_cache(defs, this))
-        app.log(this, 'Now cached %s bytes as' % size, cache_key(defs, this))
+        artifact = get_cache(defs, this)
+        app.log(this, 'Now cached %s bytes as' % os.path.getsize(artifact),
+                cache_key(defs, this))
+        query('INSERT OR REPLACE INTO unpacked VALUES (?, ?, ?)',
+              cache_key(defs, this), size, time.time())
+        record(cache_key(defs, this), artifact_size(path))
+        cull_unpacked()
         return path
     except:
         app.log(this, 'Bah! I raced on', cache_key(defs, this))
@@ -144,6 +391,226 @@ def unpack(defs, this, tmpfile):
         return False
 
 
+def artifact_size(path):
+    '''Return the space that deleting the artifact at path would free.
+
+    That's the archive and the files kept with it. The unpacked tree is
+    culled (and counted) separately, and its files are mostly shared with
+    other trees through the object store anyway.
+
+    '''
+    return sum([os.path.getsize(os.path.join(path, name))
+                for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))])
+
+
+def files(tree):
+    '''Return the list of everything in an unpacked tree, for staging.
+
+    The list comes from the manifest kept next to the tree, so that staging
+    doesn't have to walk it every time. Trees which weren't archived (eg
+    snapshots) get a manifest the first time they're needed.
+
+    '''
+    base = os.path.splitext(tree)[0]
+    manifest = get_manifest(base)
+    if manifest is None:
+        manifest = utils.tree_manifest(tree)
+        if not os.path.exists(base + '.manifest'):
+            utils.write_manifest(base + '.manifest.%s' % os.getpid(),
+                                 manifest)
+            os.rename(base + '.manifest.%s' % os.getpid(),
+                      base + '.manifest')
+    return utils.staging_list(manifest)
+
+
+def get_manifest(artifact):
+    '''Return the manifest saved with an artifact, if there is one.
+
+    This is a list of (path, type, mode, size, sha256, link target, rdev)
+    for everything in the artifact, as written while archiving it, so we
+    can find out what it contains without unpacking it or reading the tree.
+
+    '''
+    try:
+        return utils.read_manifest(artifact + '.manifest')
+    except IOError:
+        return None
+
+
+def store(this, tree, manifest=None, mtime=None):
+    '''Replace the files in an unpacked tree by hardlinks into the store.
+
+    The object store holds one copy of each distinct file, named by the
+    sha256 of its contents plus its mode and ownership (which hardlinks
+    share), so consecutive versions of an artifact share most of their
+    disk space. The link count of an object tells us how many trees use it.
+    If we have the artifact's manifest we take the sha256s from there
+    rather than reading every file again. If mtime is given, the files'
+    timestamps are set to it on the way.
+
+    '''
+    digests = dict((os.path.normpath(entry[0]), entry[4])
+                   for entry in manifest or [])
+    stored = shared = 0
+    linking = True
+    for dirname, subdirs, basenames in os.walk(tree):
+        for basename in basenames:
+            path = os.path.join(dirname, basename)
+            info = os.lstat(path)
+            if not stat.S_ISREG(info.st_mode):
+                continue
+            if mtime is not None and info.st_mtime != mtime:
+                os.utime(path, (mtime, mtime))
+            if not linking or info.st_nlink > 1:
+                continue
+            digest = digests.get(os.path.relpath(path, tree)) or \
+                utils.hash_file(path)
+            name = '%s.%o.%s.%s' % (digest, info.st_mode, info.st_uid,
+                                    info.st_gid)
+            objectdir = os.path.join(app.config['objects'], name[:2])
+            if not os.path.isdir(objectdir):
+                try:
+                    os.makedirs(objectdir)
+                except OSError:
+                    pass
+            obj = os.path.join(objectdir, name)
+            try:
+                os.link(path, obj)
+                stored += 1
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    app.log(this, 'WARNING: object store is not on the same '
+                            'filesystem as', tree)
+                    linking = False
+                    continue
+                if e.errno != errno.EEXIST:
+                    raise
+                try:
+                    os.link(obj, path + '.stored')
+                    os.rename(path + '.stored', path)
+                    shared += 1
+                except OSError:
+                    # the object was culled while we were looking at it
+                    pass
+
+    if app.config.get('log-verbose'):
+        app.log(this, 'Stored %s new files, %s shared, from' %
+                (stored, shared), tree)
+
+
+def evict(artifact_dir, keep=[]):
+    '''Delete artifacts if free space is below the low watermark.
+
+    If there is less than 'min-gigabytes' free, we delete artifacts until
+    there should be 'cull-gigabytes' free, going by the sizes recorded in the
+    index (working them out for any artifacts it doesn't know about). The
+    'cull-policy' decides the order: 'lru' deletes the least recently used
+    first, 'size' weights that by size so big old artifacts go first.
+    Artifacts for the keys in keep, or locked by another instance, are left
+    alone. When the sizes say we're done, we cull the object store and check
+    the actual free space before stopping.
+
+    '''
+    gigabyte = 1000000000
+    fs = os.statvfs(artifact_dir)
+    free = fs.f_frsize * fs.f_bavail
+    low = app.config.get('min-gigabytes', 10) * gigabyte
+    if free > low:
+        app.log('SETUP', '%sGB is enough free space' % (free / gigabyte))
+        return
+    high = max(app.config.get('cull-gigabytes', 20) * gigabyte, low)
+
+    artifacts = {}
+    for name in os.listdir(artifact_dir):
+        match = re.match('^(.*\.[0-9a-f]{64})', name)
+        artifacts.setdefault(match.group(1) if match else name, []).append(
+            name)
+
+    try:
+        known = dict((key, (size, used)) for key, size, used in
+                     get_index().execute('SELECT cache, size, used '
+                                         'FROM artifacts').fetchall())
+    except sqlite3.Error:
+        known = {}
+
+    candidates = []
+    for key, names in artifacts.items():
+        if key in keep:
+            continue
+        size, used = known.get(key, (None, None))
+        paths = [os.path.join(artifact_dir, name) for name in names]
+        if used is None:
+            used = max([os.stat(path).st_mtime for path in paths])
+        if size is None:
+            size = sum([artifact_size(path) if os.path.isdir(path)
+                        else os.path.getsize(path) for path in paths])
+            if os.path.isdir(os.path.join(artifact_dir, key)):
+                # not eg the log of a failed build, which isn't cached
+                record(key, size, used)
+        candidates.append((key, paths, size, used))
+
+    now = time.time()
+    if app.config.get('cull-policy', 'lru') == 'size':
+        candidates.sort(key=lambda c: (now - c[3]) * c[2], reverse=True)
+    else:
+        candidates.sort(key=lambda c: c[3])
+
+    deleted = freed = culled_size = 0
+    for key, paths, size, used in candidates:
+        if free + freed >= high:
+            # see how much is really free, now that the objects used only
+            # by the culled unpacked trees can go too
+            cull_objects()
+            fs = os.statvfs(artifact_dir)
+            free, freed = fs.f_frsize * fs.f_bavail, 0
+            if free >= high:
+                break
+        artifact = os.path.join(artifact_dir, key, key)
+        try:
+            with open(artifact + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                culled = os.path.join(artifact_dir, '.culled.%s' % key)
+                os.rename(os.path.join(artifact_dir, key), culled)
+        except (IOError, OSError):
+            if os.path.isdir(os.path.join(artifact_dir, key)):
+                continue
+            culled = None
+        for path in paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        if culled:
+            shutil.rmtree(culled)
+        forget(key)
+        deleted += 1
+        freed += size
+        culled_size += size
+
+    app.log('SETUP', 'Culled %s artifacts, %sGB from' %
+            (deleted, culled_size / gigabyte), artifact_dir)
+    fs = os.statvfs(artifact_dir)
+    free = fs.f_frsize * fs.f_bavail
+    if free < low:
+        app.log('SETUP', 'ERROR: %sGB is less than min-gigabytes' %
+                (free / gigabyte))
+
+
+def cull_objects():
+    '''Delete objects from the store which are no longer used by any tree.'''
+    culled = size = 0
+    for dirname, subdirs, basenames in os.walk(app.config['objects']):
+        for basename in basenames:
+            path = os.path.join(dirname, basename)
+            info = os.lstat(path)
+            if info.st_nlink == 1:
+                os.remove(path)
+                culled += 1
+                size += info.st_size
+    if culled > 0:
+        app.log('SETUP', 'Culled %s objects, %s bytes from' % (culled, size),
+                app.config['objects'])
+
+
 def upload(defs, this):
     cachefile = get_cache(defs, this)
     url = app.config['kbas-url'] + 'upload'
@@ -172,32 +639,125 @@ def get_cache(defs, this):
 
     cachedir = os.path.join(app.config['artifacts'], cache_key(defs, this))
     if os.path.isdir(cachedir):
-        call(['touch', cachedir])
-        artifact = os.path.join(cachedir, cache_key(defs, this))
-        unpackdir = artifact + '.unpacked'
+        os.utime(cachedir, None)
+        record(cache_key(defs, this))
+        return os.path.join(cachedir, cache_key(defs, this))
+
+    return False
+
+
+@contextlib.contextmanager
+def unpacked(defs, this):
+    '''Provide the unpacked tree for a cached artifact, unpacking if need be.
+
+    We hold a shared lock on the tree while it's in use, so that another
+    instance can't cull it from underneath us.
+
+    '''
+    artifact = get_cache(defs, this)
+    if artifact is False:
+        app.exit(this, 'ERROR: no cached artifact for', this['name'])
+
+    unpackdir = artifact + '.unpacked'
+    with open(artifact + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
         if not os.path.isdir(unpackdir):
             tempfile.tempdir = app.config['tmp']
             tmpdir = tempfile.mkdtemp()
-            if call(['tar', 'xf', artifact, '--directory', tmpdir]):
-                app.log(this, 'Problem unpacking', artifact)
-                return False
+            if not utils.unpack_archive(artifact, tmpdir):
+                shutil.rmtree(tmpdir)
+                app.exit(this, 'ERROR: problem unpacking', artifact)
+            store(this, tmpdir, get_manifest(artifact))
             try:
                 os.rename(tmpdir, unpackdir)
+                query('INSERT OR REPLACE INTO unpacked VALUES (?, ?, ?)',
+                      cache_key(defs, this), utils.directory_size(unpackdir),
+                      time.time())
             except:
-                # corner case... if we are here ybd is multi-instance, this
-                # artifact was uploaded from somewhere, and more than one
-                # instance is attempting to unpack. another got there first
-                pass
-        return os.path.join(cachedir, cache_key(defs, this))
+                # corner case... if we are here ybd is multi-instance, and
+                # another instance unpacked this while we were doing it too
+                shutil.rmtree(tmpdir)
+            cull_unpacked()
+        query('UPDATE unpacked SET used = ? WHERE cache = ?', time.time(),
+              cache_key(defs, this))
+        yield unpackdir
 
-    return False
+
+def cull_unpacked():
+    '''Delete least recently used unpacked trees to keep within budget.
+
+    The budget is set by 'unpacked-gigabytes', and is separate from the
+    space used by the artifacts themselves. Trees which are locked by
+    unpacked() are in use, so we leave them alone.
+
+    '''
+    if app.config.get('unpacked-gigabytes') is None:
+        return
+    budget = app.config['unpacked-gigabytes'] * 1000000000
+    try:
+        trees = get_index().execute('SELECT cache, size FROM unpacked '
+                                    'ORDER BY used').fetchall()
+    except sqlite3.Error as e:
+        app.log('INDEX', 'WARNING: problem with index:', e)
+        return
+
+    total = sum([size for key, size in trees])
+    for key, size in trees:
+        if total <= budget:
+            return
+        artifact = os.path.join(app.config['artifacts'], key, key)
+        if os.path.isdir(artifact + '.unpacked'):
+            try:
+                with open(artifact + '.lock', 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    culled = '%s.culled.%s' % (artifact, os.getpid())
+                    os.rename(artifact + '.unpacked', culled)
+                shutil.rmtree(culled)
+            except (IOError, OSError):
+                continue
+        query('DELETE FROM unpacked WHERE cache = ?', key)
+        total -= size
+
+
+def cull_sources():
+    '''Delete least recently used entries from the source cache.
+
+    The budget is set by 'sources-gigabytes'. Entries which are locked by
+    repos.cached_source() are in use, so we leave them alone.
+
+    '''
+    if not app.config.get('source-cache') or \
+            app.config.get('sources-gigabytes') is None:
+        return
+    budget = app.config['sources-gigabytes'] * 1000000000
+    try:
+        entries = get_index().execute('SELECT name, size FROM sources '
+                                      'ORDER BY used').fetchall()
+    except sqlite3.Error as e:
+        app.log('INDEX', 'WARNING: problem with index:', e)
+        return
+
+    total = sum([size for name, size in entries])
+    for name, size in entries:
+        if total <= budget:
+            return
+        path = os.path.join(app.config['sources'], name)
+        if os.path.isdir(path):
+            try:
+                with open(path + '.lock', 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    culled = '%s.culled.%s' % (path, os.getpid())
+                    os.rename(path, culled)
+                    os.remove(path + '.lock')
+                shutil.rmtree(culled)
+            except (IOError, OSError):
+                continue
+        query('DELETE FROM sources WHERE name = ?', name)
+        total -= size
 
 
 def get_remote(defs, this):
     ''' If a remote cached artifact exists for this, retrieve it '''
-    if app.config.get('last-retry-component') == this:
-        return False
-
     if this.get('kind', 'chunk') != 'chunk':
         return False
 
@@ -211,6 +771,9 @@ def get_remote(defs, this):
         return False
 
     if response.status_code == 200:
+        if app.config.get('log-verbose'):
+            app.log(this, 'Remote artifact compression is',
+                    response.headers.get('X-Artifact-Codec', 'unknown'))
         try:
             tempfile.tempdir = app.config['tmp']
             tmpdir = tempfile.mkdtemp()
@@ -18,10 +18,17 @@ import yaml
 import os
 import app
 import cache
-from subprocess import check_output, PIPE
+import cPickle
 import hashlib
+import marshal
+from multiprocessing import Pool, cpu_count
 import defaults
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 class Definitions(object):
 
@@ -29,6 +36,10 @@ class Definitions(object):
         '''Load all definitions from a directory tree.'''
         self._definitions = {}
         self._trees = {}
+        self._fingerprints = {}
+        self._files = {}
+        self._stale = set()
+        self._changing = False
 
         json_schema = self._load(app.config.get('json-schema'))
         definitions_schema = self._load(app.config.get('defs-schema'))
@@ -37,8 +48,9 @@ class Definitions(object):
             js.validate(json_schema, json_schema)
             js.validate(definitions_schema, json_schema)
 
-        things_have_changed = not self._check_trees()
+        self._check_trees()
         with app.chdir(directory):
+            paths = []
             for dirname, dirnames, filenames in os.walk('.'):
                 filenames.sort()
                 dirnames.sort()
@@ -46,20 +58,24 @@ class Definitions(object):
                     dirnames.remove('.git')
                 for filename in filenames:
                     if filename.endswith(('.def', '.morph')):
-                        contents = self._load(os.path.join(dirname, filename))
-                        if contents is not None:
-                            if things_have_changed and definitions_schema:
-                                app.log(filename, 'Validating schema')
-                                js.validate(contents, definitions_schema)
-                            self._fix_keys(contents)
-                            self._tidy_and_insert_recursively(contents)
+                        paths.append(os.path.join(dirname, filename))
+
+            parsed = self._load_all(paths, definitions_schema)
+            for path in paths:
+                changed = self._changed(path)
+                contents = self._check(path, parsed[path])
+                if contents is not None:
+                    self._fix_keys(contents)
+                    self._changing = changed
+                    self._tidy_and_insert_recursively(contents)
 
         self.defaults = defaults.Defaults()
 
-        caches_are_valid = self._check_trees()
         for path in self._definitions:
             try:
                 this = self._definitions[path]
+                if path in self._stale:
+                    continue
                 if this.get('ref') and self._trees.get(path):
                     if this['ref'] == self._trees.get(path)[0]:
                         this['tree'] = self._trees.get(path)[1]
@@ -86,10 +102,16 @@ class Definitions(object):
         try:
             with open(path) as f:
                 text = f.read()
-            contents = yaml.safe_load(text)
+            contents = yaml.load(text, Loader=SafeLoader)
         except:
             app.log('DEFINITIONS', 'WARNING: problem loading', path)
             return None
+        return self._check(path, contents)
+
+    def _check(self, path, contents):
+        if contents is None:
+            app.log('DEFINITIONS', 'WARNING: problem loading', path)
+            return None
         if type(contents) is not dict:
             app.log('DEFINITIONS', 'WARNING: %s contents is not dict:' % path,
                     str(contents)[0:50])
@@ -97,6 +119,98 @@ class Definitions(object):
         contents['path'] = path[2:]
         return contents
 
+    def _load_all(self, paths, schema=None):
+        '''Parse (and validate) the definition files at paths, into a dict.
+
+        Parsed contents are kept (marshalled) in a file in the base directory,
+        named for the definitions directory, and keyed by a hash of the file
+        contents, along with the result of validating each one against the
+        schema. So we only parse and validate files which are new or have
+        changed since the last run, or everything if the schema has changed.
+        That work is spread across all cores, and any validation errors are
+        reported together at the end.
+
+        The cache is never kept in (or read from) the definitions checkout,
+        since whoever provides the definitions could provide that too.
+
+        '''
+        schema_digest = None
+        if schema:
+            schema_digest = hashlib.sha1(cPickle.dumps(schema)).hexdigest()
+        cachefile = os.path.join(app.config['base'], 'parsed',
+                                 hashlib.sha1(os.getcwd()).hexdigest())
+        try:
+            with open(cachefile, 'rb') as f:
+                cached = marshal.load(f)
+            parsed, errors = cached['files'], cached['errors']
+            if cached['schema'] != schema_digest:
+                errors = {}
+        except:
+            parsed, errors = {}, {}
+
+        digests = {}
+        texts = {}
+        changed = {}
+        for path in paths:
+            try:
+                with open(path) as f:
+                    text = f.read()
+            except:
+                text = ''
+            digests[path] = hashlib.sha1(text).hexdigest()
+            texts[path] = text
+            if digests[path] not in parsed or \
+                    (schema and digests[path] not in errors):
+                changed[digests[path]] = text
+
+        if changed:
+            app.log('DEFINITIONS', 'Parsing %s new or changed files' %
+                    len(changed))
+            if len(changed) > 1 and cpu_count() > 1:
+                pool = Pool(min(cpu_count(), len(changed)),
+                            initializer=set_validator, initargs=(schema,))
+                try:
+                    results = pool.map(parse, changed.values(), chunksize=16)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                set_validator(schema)
+                results = map(parse, changed.values())
+            for digest, result in zip(changed.keys(), results):
+                parsed[digest], errors[digest] = result
+
+            parsed = dict((digests[path], parsed[digests[path]])
+                          for path in paths)
+            errors = dict((digests[path], errors.get(digests[path]))
+                          for path in paths)
+            try:
+                if not os.path.isdir(os.path.dirname(cachefile)):
+                    os.makedirs(os.path.dirname(cachefile))
+                with open(cachefile + '.tmp', 'wb') as f:
+                    marshal.dump({'schema': schema_digest, 'files': parsed,
+                                  'errors': errors}, f)
+                os.rename(cachefile + '.tmp', cachefile)
+            except:
+                app.log('DEFINITIONS', 'WARNING: unable to save', cachefile)
+
+        failed = [path for path in paths if errors.get(digests[path])]
+        for path in failed:
+            for error in errors[digests[path]]:
+                app.log(path[2:], 'ERROR: schema validation failed:', error)
+        if failed:
+            app.exit('DEFINITIONS', 'ERROR: schema validation failed for',
+                     '%s files' % len(failed))
+
+        result = {}
+        for path in paths:
+            if parsed[digests[path]] is None:
+                # couldn't be marshalled (eg it has dates), so parse it again
+                result[path] = yaml.load(texts[path], Loader=SafeLoader)
+            else:
+                result[path] = marshal.loads(parsed[digests[path]])
+        return result
+
     def _tidy_and_insert_recursively(self, definition):
         '''Insert a definition and its contents into the dictionary.
 
@@ -179,6 +293,8 @@ class Definitions(object):
         duplicated in the existing definition, output a warning.
 
         '''
+        if self._changing:
+            self._stale.add(new_def['path'])
         definition = self._definitions.get(new_def['path'])
         if definition:
             if (definition.get('ref') is None or new_def.get('ref') is None):
@@ -209,39 +325,75 @@ class Definitions(object):
 
         return self._definitions.get(definition['path'])
 
+    def components(self, target):
+        '''Return the definitions needed to create target, target included.
+
+        Follows build-depends, contents and (sub)systems, so the result is
+        everything that cache_key() will visit for the target.
+
+        '''
+        found = []
+        seen = set()
+
+        def walk(it):
+            definition = self.get(it)
+            if definition is None or definition['path'] in seen:
+                return
+            seen.add(definition['path'])
+            for dependency in definition.get('build-depends', []):
+                walk(dependency)
+            for content in definition.get('contents', []):
+                walk(content)
+            for system in definition.get('systems', []):
+                walk_system(system)
+            found.append(definition)
+
+        def walk_system(system):
+            walk(system.get('path', 'BROKEN'))
+            for subsystem in system.get('subsystems', []):
+                walk_system(subsystem)
+
+        walk(target)
+        return found
+
     def _check_trees(self):
-        '''True if the .trees file matches the current working subdirectories
+        '''Load the .trees file for the current working directory
 
         The .trees file lists all git trees for a set of definitions, and a
-        checksum of the checked-out subdirectories when we calculated them.
-
-        If the checksum for the current subdirectories matches, return True
+        fingerprint (size, mtime, inode) of each definition file as it was
+        when we calculated them. Tree entries are only trusted for
+        definitions which come from files whose fingerprint still matches.
 
         '''
         try:
-            with app.chdir(app.config['defdir']):
-                checksum = check_output('ls -lRA */', shell=True)
-            checksum = hashlib.md5(checksum).hexdigest()
             with open('.trees') as f:
                 text = f.read()
             self._trees = yaml.safe_load(text)
-            if self._trees.get('.checksum') == checksum:
-                return True
+            self._fingerprints = self._trees.get('.files', {})
         except:
             self._trees = {}
+            self._fingerprints = {}
 
-        return False
+    def _changed(self, path):
+        '''True if the file at path is not as recorded in the .trees file'''
+        if path is None:
+            return False
+        try:
+            stat = os.stat(path)
+            fingerprint = [stat.st_size, stat.st_mtime, stat.st_ino]
+        except OSError:
+            fingerprint = None
+        path = os.path.normpath(path)
+        self._files[path] = fingerprint
+        return self._fingerprints.get(path) != fingerprint
 
     def save_trees(self):
         '''Creates the .trees file for the current working directory
 
         .trees contains a list of git trees for all the definitions, and a
-        checksum for the state of the working subdirectories
+        fingerprint for each of the definition files they came from
         '''
-        with app.chdir(app.config['defdir']):
-            checksum = check_output('ls -lRA */', shell=True)
-        checksum = hashlib.md5(checksum).hexdigest()
-        self._trees = {'.checksum': checksum}
+        self._trees = {'.files': self._files}
         for name in self._definitions:
             if self._definitions[name].get('tree') is not None:
                 self._trees[name] = [self._definitions[name]['ref'],
@@ -249,3 +401,43 @@ class Definitions(object):
 
         with open(os.path.join(os.getcwd(), '.trees'), 'w') as f:
             f.write(yaml.safe_dump(self._trees, default_flow_style=False))
+
+
+validator = None
+
+
+def set_validator(schema):
+    '''Compile the definitions schema, once per process.'''
+    global validator
+    validator = None
+    if schema:
+        import jsonschema as js
+        cls = js.validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = cls(schema)
+
+
+def parse(text):
+    '''Parse yaml text, returning the result marshalled.
+
+    If there is a validator, also return a list of the problems it finds in
+    the contents (empty if it's valid). Contents which can't be marshalled
+    (eg yaml dates) are returned as None, to be parsed again when needed.
+
+    '''
+    try:
+        contents = yaml.load(text, Loader=SafeLoader)
+    except:
+        contents = None
+
+    errors = None
+    if validator and type(contents) is dict:
+        errors = []
+        for error in validator.iter_errors(contents):
+            location = '/'.join(str(x) for x in error.path)
+            errors.append('%s: %s' % (location, error.message))
+
+    try:
+        return marshal.dumps(contents), errors
+    except ValueError:
+        return None, errors
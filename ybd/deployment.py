@@ -15,11 +15,11 @@
 # =*= License: GPL-2 =*=
 
 import os
-from subprocess import call
 import json
 import app
 import cache
 import sandbox
+import utils
 
 
 def deploy(defs, target):
@@ -46,8 +46,7 @@ def deploy_system(defs, system_spec, parent_location=''):
 
     sandbox.setup(system)
     app.log(system, 'Extracting system artifact into', system['sandbox'])
-    with open(cache.get_cache(defs, system), 'r') as artifact:
-        call(['tar', 'x', '--directory', system['sandbox']], stdin=artifact)
+    utils.unpack_archive(cache.get_cache(defs, system), system['sandbox'])
 
     for subsystem in system_spec.get('subsystems', []):
         if deploy_defaults:
@@ -14,13 +14,17 @@
 #
 # =*= License: GPL-2 =*=
 
+import collections
+import contextlib
+import fcntl
 import os
 import json
-import re
 import shutil
 import string
-from subprocess import call, check_output, check_call
+from subprocess import call, check_output, check_call, Popen, PIPE
+from multiprocessing.pool import ThreadPool
 import sys
+import time
 
 import requests
 
@@ -59,13 +63,14 @@ def get_repo_name(repo):
 
 def get_version(gitdir, ref='HEAD'):
     try:
-        with app.chdir(gitdir), open(os.devnull, "w") as fnull:
+        with open(os.devnull, "w") as fnull:
             described = check_output(['git', 'describe', '--tags', '--dirty'],
-                                     stderr=fnull)[0:-1]
+                                     cwd=gitdir, stderr=fnull)[0:-1]
             last_tag = check_output(['git', 'describe', '--abbrev=0',
-                                     '--tags', ref], stderr=fnull)[0:-1]
+                                     '--tags', ref], cwd=gitdir,
+                                    stderr=fnull)[0:-1]
             commits = check_output(['git', 'rev-list', last_tag + '..' + ref,
-                                    '--count'])[0:-1]
+                                    '--count'], cwd=gitdir)[0:-1]
         result = "%s %s (%s + %s commits)" % (ref[:8], described, last_tag,
                                               commits)
     except:
@@ -100,7 +105,7 @@ def get_tree(this):
                 stderr=fnull):
             # can't resolve this ref. is it upstream?
             app.log(this, 'Fetching from upstream to resolve %s' % ref)
-            call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull)
+            fetch(gitdir, [ref], this['name'])
 
         try:
             tree = check_output(['git', 'rev-parse', ref + '^{tree}'],
@@ -113,90 +118,366 @@ def get_tree(this):
             app.exit(this, 'ERROR: could not find tree for ref', (ref, gitdir))
 
 
-def mirror(name, repo):
-    tempfile.tempdir = app.config['tmp']
-    tmpdir = tempfile.mkdtemp()
-    repo_url = get_repo_url(repo)
+def get_trees(definitions):
+    '''Resolve 'tree' for all of the definitions in as few git calls as we can
+
+    Refs are grouped by the mirror they come from, and each group is resolved
+    by a single `git cat-file --batch-check` process. Mirrors are processed in
+    parallel on a bounded pool. Anything which can't be resolved this way
+    (no local mirror yet, or a bad ref) is left for get_tree() to deal with.
+
+    '''
+    groups = {}
+    for this in definitions:
+        if this.get('repo') and this.get('ref') and not this.get('tree'):
+            gitdir = os.path.join(app.config['gits'],
+                                  get_repo_name(this['repo']))
+            if this['repo'].startswith('file://') or \
+                    this['repo'].startswith('/'):
+                gitdir = this['repo'].replace('file://', '')
+            if os.path.isdir(gitdir):
+                groups.setdefault(gitdir, []).append(this)
+
+    if not groups:
+        return
+
+    pool = ThreadPool(min(len(groups), app.config.get('git-workers', 8)))
     try:
-        tar_file = get_repo_name(repo_url) + '.tar'
-        app.log(name, 'Try fetching tarball %s' % tar_file)
-        # try tarball first
-        with app.chdir(tmpdir), open(os.devnull, "w") as fnull:
-            call(['wget', os.path.join(app.config['tar-url'], tar_file)])
-            call(['tar', 'xf', tar_file], stderr=fnull)
-            os.remove(tar_file)
-            call(['git', 'config', 'remote.origin.url', repo_url])
-            call(['git', 'config', 'remote.origin.mirror', 'true'])
-            if call(['git', 'config', 'remote.origin.fetch',
-                     '+refs/*:refs/*']) != 0:
-                raise BaseException('Did not get a valid git repo')
-            call(['git', 'fetch', 'origin'])
-    except:
-        app.log(name, 'Try git clone from', repo_url)
-        with open(os.devnull, "w") as fnull:
-            if call(['git', 'clone', '--mirror', '-n', repo_url, tmpdir]):
-                app.exit(name, 'ERROR: failed to clone', repo)
+        results = pool.map(resolve_refs, groups.items())
+    finally:
+        pool.close()
+        pool.join()
+
+    count = 0
+    for trees in results:
+        for this, tree in trees:
+            this['tree'] = tree
+            count += 1
+    app.log('TREES', 'Resolved %s trees from %s mirrors' % (count,
+                                                            len(groups)))
+
+
+def resolve_refs(group):
+    '''Return (definition, tree) pairs for all refs we can find in gitdir'''
+    gitdir, definitions = group
+    refs = sorted(set([this['ref'] for this in definitions]))
+    trees = batch_check(gitdir, refs)
+    missing = [ref for ref in refs if trees.get(ref) is None]
+    if missing:
+        fetch(gitdir, missing)
+        trees.update(batch_check(gitdir, missing))
+
+    return [(this, trees[this['ref']]) for this in definitions
+            if trees.get(this['ref'])]
+
+
+def batch_check(gitdir, refs):
+    '''Map each ref to its tree sha1 using one git process for all of them'''
+    trees = {}
+    with open(os.devnull, "w") as fnull:
+        try:
+            process = Popen(['git', 'cat-file', '--batch-check'], cwd=gitdir,
+                            stdin=PIPE, stdout=PIPE, stderr=fnull,
+                            universal_newlines=True)
+            output = process.communicate(
+                ''.join(['%s^{tree}\n' % ref for ref in refs]))[0]
+        except:
+            return trees
 
-    with app.chdir(tmpdir):
-        if call(['git', 'rev-parse']):
-            app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
+    # one line of output per line of input: '<sha1> tree <size>' if found,
+    # otherwise '<ref>^{tree} missing' (or 'ambiguous')
+    for ref, line in zip(refs, output.splitlines()):
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == 'tree':
+            trees[ref] = fields[0]
+    return trees
+
+
+def prefetch(definitions):
+    '''Mirror or update the repos for definitions, in the background.
+
+    This forks a process which works through the repos on a pool of
+    'git-workers' threads, in the order the definitions are given (ie the
+    order they'll be built in), so that fetching overlaps rather than each
+    build waiting for its own. Anything which needs a mirror while this is
+    going on waits for it (see mirror_lock), or just does it itself if the
+    prefetch hasn't got there yet.
+
+    '''
+    repos = collections.OrderedDict()
+    for this in definitions:
+        if this.get('repo') and this.get('ref'):
+            refs = repos.setdefault(this['repo'], (this['name'], set()))[1]
+            refs.add(this['ref'])
+    if not repos or os.fork():
+        return
 
-    gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
     try:
-        os.rename(tmpdir, gitdir)
-        app.log(name, 'Git repo is mirrored at', gitdir)
-    except:
-        pass
+        pool = ThreadPool(min(len(repos), app.config.get('git-workers', 8)))
+        with app.timer('PREFETCH', 'prefetch of %s repos' % len(repos)):
+            list(pool.imap(prefetch_repo, repos.items()))
+        pool.close()
+    finally:
+        os._exit(0)
+
+
+def prefetch_repo(item):
+    '''Make sure the mirror of a repo has all of the refs we need from it.'''
+    repo, (name, refs) = item
+    gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
+    if not os.path.exists(gitdir):
+        mirror(name, repo)
+    else:
+        found = batch_check(gitdir, sorted(refs))
+        missing = [ref for ref in refs if ref not in found]
+        if missing:
+            update_mirror(name, repo, gitdir, missing)
 
 
-def fetch(repo):
-    with app.chdir(repo), open(os.devnull, "w") as fnull:
-        call(['git', 'fetch', 'origin'], stdout=fnull, stderr=fnull)
+@contextlib.contextmanager
+def mirror_lock(gitdir):
+    '''Hold a lock on the mirror at gitdir while we create or update it.'''
+    if os.path.dirname(gitdir) != app.config['gits']:
+        # not one of ours, eg a local repo used directly
+        yield
+        return
+    with open(gitdir + '.lock', 'a') as l:
+        fcntl.flock(l, fcntl.LOCK_EX)
+        yield
+
+
+def mirror(name, repo):
+    gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
+    with mirror_lock(gitdir):
+        if os.path.exists(gitdir):
+            # someone else mirrored it while we waited
+            return
+
+        tmpdir = tempfile.mkdtemp(dir=app.config['tmp'])
+        repo_url = get_repo_url(repo)
+        try:
+            tar_file = get_repo_name(repo_url) + '.tar'
+            app.log(name, 'Try fetching tarball %s' % tar_file)
+            # try tarball first
+            with open(os.devnull, "w") as fnull:
+                call(['wget', '-q',
+                      os.path.join(app.config['tar-url'], tar_file)],
+                     cwd=tmpdir)
+                call(['tar', 'xf', tar_file], stderr=fnull, cwd=tmpdir)
+                os.remove(os.path.join(tmpdir, tar_file))
+                call(['git', 'config', 'remote.origin.url', repo_url],
+                     cwd=tmpdir)
+                call(['git', 'config', 'remote.origin.mirror', 'true'],
+                     cwd=tmpdir)
+                if call(['git', 'config', 'remote.origin.fetch',
+                         '+refs/*:refs/*'], cwd=tmpdir) != 0:
+                    raise BaseException('Did not get a valid git repo')
+                call(['git', 'fetch', 'origin'], cwd=tmpdir)
+        except:
+            app.log(name, 'Try git clone from', repo_url)
+            with open(os.devnull, "w") as fnull:
+                if call(['git', 'clone', '--mirror', '-n', repo_url, tmpdir]):
+                    app.exit(name, 'ERROR: failed to clone', repo)
+
+        if call(['git', 'rev-parse'], cwd=tmpdir):
+            app.exit(name, 'ERROR: problem mirroring git repo at', tmpdir)
+
+        try:
+            os.rename(tmpdir, gitdir)
+            app.log(name, 'Git repo is mirrored at', gitdir)
+        except:
+            pass
+
+
+def fetch(gitdir, refs=None, name='GIT'):
+    '''Fetch refs from upstream into the mirror at gitdir.
+
+    On a big mirror, fetching everything can take minutes when all we want
+    is one missing sha, so we first ask for just the refs (branches, tags
+    or shas) that the mirror doesn't have. Only if that doesn't get them
+    all (eg the server won't give out an unadvertised sha) do we fetch the
+    lot. Each fetch is timed, and recorded in the index.
+
+    Returns True if the fetch worked.
+
+    '''
+    with mirror_lock(gitdir), open(os.devnull, "w") as fnull:
+        if refs:
+            missing = [ref for ref in refs if not mirror_has_ref(gitdir, ref)]
+            if not missing:
+                return True
+            start = time.time()
+            call(['git', 'fetch', 'origin'] + missing, cwd=gitdir,
+                 stdout=fnull, stderr=fnull)
+            found = all(mirror_has_ref(gitdir, ref) for ref in missing)
+            record_fetch(name, gitdir, 'refs', time.time() - start)
+            if found:
+                return True
+
+        start = time.time()
+        result = call(['git', 'remote', 'update', 'origin'], cwd=gitdir,
+                      stdout=fnull, stderr=fnull)
+        record_fetch(name, gitdir, 'all', time.time() - start)
+        return result == 0
+
+
+def record_fetch(name, gitdir, mode, seconds):
+    '''Log how long a fetch took, and keep it in the index.'''
+    import cache
+    app.log(name, 'Fetched %s into %s in %.1f seconds' % (mode, gitdir,
+                                                          seconds))
+    cache.query('INSERT INTO fetches VALUES (?, ?, ?, ?)',
+                os.path.basename(gitdir), mode, seconds, time.time())
 
 
 def mirror_has_ref(gitdir, ref):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        out = call(['git', 'cat-file', '-t', ref], stdout=fnull, stderr=fnull)
+    with open(os.devnull, "w") as fnull:
+        out = call(['git', 'cat-file', '-t', ref], cwd=gitdir, stdout=fnull,
+                   stderr=fnull)
         return out == 0
 
 
-def update_mirror(name, repo, gitdir):
-    with app.chdir(gitdir), open(os.devnull, "w") as fnull:
-        app.log(name, 'Refreshing mirror for %s' % repo)
-        if call(['git', 'remote', 'update', 'origin'], stdout=fnull,
-                stderr=fnull):
-            app.exit(name, 'ERROR: git update mirror failed', repo)
+def update_mirror(name, repo, gitdir, refs=None):
+    app.log(name, 'Refreshing mirror for %s' % repo)
+    if not fetch(gitdir, refs, name):
+        app.exit(name, 'ERROR: git update mirror failed', repo)
 
 
-def checkout(name, repo, ref, checkout):
+def checkout(name, repo, ref, checkout, tree=None, submodules=True):
+    '''Check out ref of repo into the checkout directory.
+
+    Returns a list of (path, url, commit) for the submodules which were
+    checked out with it, at any depth.
+
+    '''
     gitdir = os.path.join(app.config['gits'], get_repo_name(repo))
     if not os.path.exists(gitdir):
         mirror(name, repo)
     elif not mirror_has_ref(gitdir, ref):
-        update_mirror(name, repo, gitdir)
-    # checkout the required version of this from git
-    with open(os.devnull, "w") as fnull:
-        # We need to pass '--no-hardlinks' because right now there's nothing to
-        # stop the build from overwriting the files in the .git directory
-        # inside the sandbox. If they were hardlinks, it'd be possible for a
-        # build to corrupt the repo cache. I think it would be faster if we
-        # removed --no-hardlinks, though.
-        if call(['git', 'clone', '--no-hardlinks', gitdir, checkout],
-                stdout=fnull, stderr=fnull):
-            app.exit(name, 'ERROR: git clone failed for', ref)
-
-        with app.chdir(checkout):
-            if call(['git', 'checkout', '--force', ref], stdout=fnull,
-                    stderr=fnull):
+        update_mirror(name, repo, gitdir, [ref])
+
+    if app.config.get('source-cache'):
+        # copy the files from the source cache, rather than clone the repo
+        if not tree:
+            tree = check_output(['git', 'rev-parse', ref + '^{tree}'],
+                                cwd=gitdir).strip()
+        with source(name, repo, ref, tree) as path:
+            utils.copy_all_files(path, checkout)
+        if app.config.get('shallow-git', True):
+            with shallow_git(name, ref, gitdir) as path:
+                utils.copy_all_files(path, os.path.join(checkout, '.git'))
+        app.log(name, 'Git checkout %s in %s' % (repo, checkout))
+        app.log(name, 'Upstream version %s' % get_version(checkout, ref))
+
+    else:
+        # checkout the required version of this from git
+        with open(os.devnull, "w") as fnull:
+            # We need to pass '--no-hardlinks' because right now there's
+            # nothing to stop the build from overwriting the files in the .git
+            # directory inside the sandbox. If they were hardlinks, it'd be
+            # possible for a build to corrupt the repo cache. I think it would
+            # be faster if we removed --no-hardlinks, though.
+            if call(['git', 'clone', '--no-hardlinks', gitdir, checkout],
+                    stdout=fnull, stderr=fnull):
+                app.exit(name, 'ERROR: git clone failed for', ref)
+
+            if call(['git', 'checkout', '--force', ref], cwd=checkout,
+                    stdout=fnull, stderr=fnull):
                 app.exit(name, 'ERROR: git checkout failed for', ref)
 
             app.log(name, 'Git checkout %s in %s' % (repo, checkout))
             app.log(name, 'Upstream version %s' % get_version(checkout, ref))
 
-            if os.path.exists('.gitmodules'):
-                checkout_submodules(name, ref)
-
+    result = []
+    if submodules and os.path.exists(os.path.join(checkout, '.gitmodules')):
+        result = checkout_submodules(name, ref, gitdir, checkout)
     utils.set_mtime_recursively(checkout)
+    return result
+
+
+@contextlib.contextmanager
+def cached_source(name, make):
+    '''Yield the path of an entry in the source cache, making it if need be.
+
+    make(tmpdir) is called to fill in a missing entry. A shared lock is held
+    on the entry while it's in use, so cull_sources() leaves it alone.
+
+    '''
+    import cache
+    path = os.path.join(app.config['sources'], name)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if not os.path.isdir(path):
+            tmpdir = tempfile.mkdtemp(dir=app.config['sources'])
+            make(tmpdir)
+            try:
+                os.rename(tmpdir, path)
+            except OSError:
+                # someone else made it first
+                shutil.rmtree(tmpdir)
+        cache.record_source(name, path)
+        yield path
+
+
+def source(name, repo, ref, tree):
+    '''Return the source cache entry holding the files of a git tree.
+
+    The source cache holds one extracted copy of each tree we build from,
+    named by its sha, so we only pay for extracting it from git once. Builds
+    get a copy (which is a reflink where the filesystem allows) since they
+    are free to change their sources.
+
+    '''
+    return cached_source(tree, lambda tmpdir:
+                         extract_commit(name, repo, tree, tmpdir))
+
+
+def shallow_git(name, ref, gitdir):
+    '''Return the source cache entry for a .git holding the commit for ref.
+
+    This is for the builds that want to run git (eg for git describe) in a
+    checkout from the source cache. It has just enough history to reach the
+    latest tag (annotated or not) and the tags themselves, so describe gives
+    the same answer as it would in a full clone.
+
+    '''
+    commit = check_output(['git', 'rev-parse', ref + '^{commit}'],
+                          cwd=gitdir).strip()
+
+    def make(tmpdir):
+        depth = 1
+        refspecs = [commit]
+        with open(os.devnull, "w") as fnull:
+            for tags in [[], ['--tags']]:
+                try:
+                    tag = check_output(['git', 'describe', '--abbrev=0'] +
+                                       tags + [commit], cwd=gitdir,
+                                       stderr=fnull).strip()
+                except:
+                    # no tags to describe from
+                    continue
+                count = check_output(['git', 'rev-list', '--count',
+                                      'refs/tags/%s..%s' % (tag, commit)],
+                                     cwd=gitdir)
+                depth = max(depth, int(count) + 1)
+                refspec = 'refs/tags/%s:refs/tags/%s' % (tag, tag)
+                if refspec not in refspecs:
+                    refspecs.append(refspec)
+
+            env = dict(os.environ, GIT_DIR=tmpdir)
+            for command in [['git', 'init', '--bare', '-q'],
+                            ['git', 'config', 'core.bare', 'false'],
+                            ['git', '-c', 'uploadpack.allowAnySHA1InWant=true',
+                             'fetch', '-q', '--depth', str(depth),
+                             'file://' + gitdir] + refspecs,
+                            ['git', 'update-ref', '--no-deref', 'HEAD',
+                             commit],
+                            ['git', 'read-tree', 'HEAD']]:
+                if call(command, env=env, stdout=fnull, stderr=fnull):
+                    app.exit(name, 'ERROR: problem making shallow git for',
+                             commit)
+
+    return cached_source(commit + '.git', make)
 
 
 def extract_commit(name, repo, ref, target_dir):
@@ -209,7 +490,7 @@ def extract_commit(name, repo, ref, target_dir):
     if not os.path.exists(gitdir):
         mirror(name, repo)
     elif not mirror_has_ref(gitdir, ref):
-        update_mirror(name, repo, gitdir)
+        update_mirror(name, repo, gitdir, [ref])
 
     with tempfile.NamedTemporaryFile() as git_index_file:
         git_env = os.environ.copy()
@@ -227,41 +508,80 @@ def extract_commit(name, repo, ref, target_dir):
     utils.set_mtime_recursively(target_dir)
 
 
-def checkout_submodules(name, ref):
+def checkout_submodules(name, ref, gitdir, checkout):
+    '''Check out the submodules of a checkout, and theirs, and so on.
+
+    Each level of submodules is fetched and checked out in parallel on up to
+    'git-workers' threads, going through the mirrors (and the source cache if
+    there is one) just like the top-level checkout.
+
+    Returns a list of (path, url, commit) for all of the submodules, with
+    paths relative to checkout.
+
+    '''
     app.log(name, 'Git submodules')
-    with open('.gitmodules', "r") as gitfile:
+    todo = list_submodules(name, ref, gitdir, checkout)
+    result = []
+    pool = ThreadPool(app.config.get('git-workers', 8))
+    try:
+        while todo:
+            result += todo
+            found = pool.map(lambda submodule:
+                             checkout_submodule(name, checkout, *submodule),
+                             todo)
+            todo = [submodule for nested in found for submodule in nested]
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def checkout_submodule(name, parent, path, url, commit):
+    '''Check out one submodule, and return the submodules within it.'''
+    fulldir = os.path.join(parent, path)
+    checkout(name, url, commit, fulldir, submodules=False)
+    gitdir = os.path.join(app.config['gits'], get_repo_name(url))
+    if not os.path.exists(os.path.join(fulldir, '.gitmodules')):
+        return []
+    return [(os.path.join(path, subpath), suburl, subcommit)
+            for subpath, suburl, subcommit
+            in list_submodules(name, commit, gitdir, fulldir)]
+
+
+def list_submodules(name, ref, gitdir, checkout):
+    '''Return (path, url, commit) for each submodule of the checkout.'''
+    with open(os.path.join(checkout, '.gitmodules'), "r") as gitfile:
         # drop indentation in sections, as RawConfigParser cannot handle it
         content = '\n'.join([l.strip() for l in gitfile.read().splitlines()])
     io = StringIO(content)
     parser = RawConfigParser()
     parser.readfp(io)
 
-    for section in parser.sections():
-        # validate section name against the 'submodule "foo"' pattern
-        submodule = re.sub(r'submodule "(.*)"', r'\1', section)
-        url = parser.get(section, 'url')
-        path = parser.get(section, 'path')
-
-        try:
-            # list objects in the parent repo tree to find the commit
-            # object that corresponds to the submodule
-            commit = check_output(['git', 'ls-tree', ref, path])
-
-            # read the commit hash from the output
-            fields = commit.split()
-            if len(fields) >= 2 and fields[1] == 'commit':
-                submodule_commit = commit.split()[2]
-
-                # fail if the commit hash is invalid
-                if len(submodule_commit) != 40:
-                    raise Exception
-
-                fulldir = os.path.join(os.getcwd(), path)
-                checkout(name, url, submodule_commit, fulldir)
-
-            else:
+    result = []
+    try:
+        urls = dict((parser.get(section, 'path'), parser.get(section, 'url'))
+                    for section in parser.sections())
+        if not urls:
+            return result
+
+        # list objects in the parent repo tree to find the commit
+        # objects that correspond to the submodules
+        tree = check_output(['git', 'ls-tree', ref, '--'] + sorted(urls),
+                            cwd=gitdir)
+        for line in tree.splitlines():
+            fields, path = line.split('\t', 1)
+            fields = fields.split()
+            if fields[1] != 'commit':
                 app.log(name, 'Skipping submodule %s, not a commit:' % path,
                         fields)
+                continue
 
-        except:
-            app.exit(name, "ERROR: git submodules problem")
+            # fail if the commit hash is invalid
+            if len(fields[2]) != 40:
+                raise Exception
+            result.append((path, urls[path], fields[2]))
+
+    except:
+        app.exit(name, "ERROR: git submodules problem")
+
+    return result
@@ -17,11 +17,14 @@
 
 import sandboxlib
 import contextlib
+import hashlib
+import json
 import os
 import pipes
 import shutil
 import stat
 import tempfile
+import time
 from subprocess import call, PIPE
 
 import app
@@ -34,6 +37,9 @@ from repos import get_repo_url
 # can be used.
 executor = None
 
+# the most lower layers an overlayfs mount can have (OVL_MAX_STACK)
+max_layers = 500
+
 
 @contextlib.contextmanager
 def setup(this):
@@ -58,23 +64,193 @@ def setup(this):
     try:
         yield
     finally:
+        # claim() goes by whether we have any sandboxes staged
+        app.config['sandboxes'].remove(assembly_dir)
+        unmount(this)
         app.remove_dir(this['sandbox'])
+        if this.get('overlay'):
+            app.remove_dir(this['overlay'])
+
+
+def installed(this, component):
+    '''Return True if component is already installed in this's sandbox.'''
+    if component['name'] in [name for name, d, c in this.get('layers', [])]:
+        return True
+    return os.path.exists(os.path.join(this['sandbox'], 'baserock',
+                                       component['name'] + '.meta'))
 
 
 def install(defs, this, component):
     # populate this['sandbox'] with the artifact files from component
-    if os.path.exists(os.path.join(this['sandbox'], 'baserock',
-                                   component['name'] + '.meta')):
+    if installed(this, component):
         return
     if app.config.get('log-verbose'):
         app.log(this, 'Sandbox: installing %s' % component['cache'])
     if cache.get_cache(defs, component) is False:
         app.exit(this, 'ERROR: unable to get cache for', component['name'])
-    unpackdir = cache.get_cache(defs, component) + '.unpacked'
-    if this.get('kind') is 'system':
-        utils.copy_all_files(unpackdir, this['sandbox'])
+    if 'layers' in this:
+        # staging on overlayfs, so just keep the tree (and its lock) until
+        # mount() puts all of the layers together
+        unpacked = cache.unpacked(defs, component)
+        this['layers'].append((component['name'], unpacked.__enter__(),
+                               unpacked))
+        return
+    with cache.unpacked(defs, component) as unpackdir:
+        start = time.time()
+        if this.get('kind') is 'system':
+            count = utils.copy_all_files(unpackdir, this['sandbox'],
+                                         cache.files(unpackdir))
+        else:
+            count = utils.hardlink_all_files(unpackdir, this['sandbox'],
+                                             cache.files(unpackdir))
+        elapsed = time.time() - start
+        if app.config.get('log-verbose') or elapsed > 1:
+            app.log(this, 'Staged %s entries from %s in %.2fs' %
+                    (count, component['name'], elapsed))
+
+
+def overlay(this):
+    '''Decide whether to stage the dependencies of this using overlayfs.
+
+    This is only for chunks, and only if 'staging' is set to 'overlay' and
+    the kernel has overlayfs and lets us mount it. Otherwise we hardlink.
+
+    '''
+    if app.config.get('staging') != 'overlay' or this.get('contents') or \
+            this.get('kind', 'chunk') != 'chunk':
+        return False
+    if 'overlay' not in app.config:
+        with open('/proc/filesystems') as f:
+            supported = 'overlay' in f.read().split()
+        app.config['overlay'] = supported and os.geteuid() == 0
+        if not app.config['overlay']:
+            app.log('SANDBOX', 'WARNING: no overlayfs, staging by hardlinks')
+    if app.config['overlay']:
+        this['layers'] = []
+    return app.config['overlay']
+
+
+def mount(this):
+    '''Mount the layers from install() as this's sandbox, on overlayfs.
+
+    The dependencies are read-only lower layers, in install order, and
+    everything already in the sandbox (the build and install directories
+    for a start) moves to the writable upper layer. If the mount fails,
+    we hardlink the layers in as usual.
+
+    The mount options are limited to a page, so each layer is given by a
+    short numbered symlink to its unpacked tree, and the kernel allows at
+    most max_layers of them. Overlayfs also can't merge a directory in one
+    layer with a symlink in another (eg a usr-merged /lib -> usr/lib) the
+    way hardlinking does, so if the layers have one of those we hardlink.
+
+    '''
+    if not this.get('layers'):
+        return
+    this['overlay'] = tempfile.mkdtemp(dir=app.config['tmp'])
+    upper = os.path.join(this['overlay'], 'upper')
+    os.makedirs(os.path.join(this['overlay'], 'work'))
+    os.makedirs(os.path.join(this['overlay'], 'l'))
+    for number, (name, unpackdir, c) in enumerate(this['layers']):
+        os.symlink(unpackdir, os.path.join(this['overlay'], 'l', str(number)))
+    os.rename(this['sandbox'], upper)
+    os.makedirs(this['sandbox'])
+
+    lowerdir = ':'.join('l/%s' % number for number in
+                        reversed(range(len(this['layers']))))
+    options = 'lowerdir=%s,upperdir=upper,workdir=work' % lowerdir
+    conflict = None
+    if len(this['layers']) > max_layers:
+        app.log(this, 'WARNING: too many layers for overlayfs',
+                len(this['layers']))
     else:
-        utils.hardlink_all_files(unpackdir, this['sandbox'])
+        conflict = conflicts(this)
+        if conflict:
+            app.log(this, 'WARNING: overlayfs would hide part of', conflict)
+        elif call(['mount', '-t', 'overlay', 'overlay', '-o', options,
+                   this['sandbox']], cwd=this['overlay']) == 0:
+            this['mounted'] = upper
+            app.log(this, 'Staged %s dependencies on overlayfs' %
+                    len(this['layers']))
+            return
+        else:
+            app.log(this, 'WARNING: overlayfs mount failed')
+
+    app.log(this, 'Staging by hardlinks instead')
+    os.rmdir(this['sandbox'])
+    os.rename(upper, this['sandbox'])
+    for name, unpackdir, unpacked in this['layers']:
+        utils.hardlink_all_files(unpackdir, this['sandbox'],
+                                 cache.files(unpackdir))
+    unmount(this)
+
+
+def conflicts(this):
+    '''Return a path which is a directory in one layer and a symlink in
+    another, if there is one.'''
+    kinds = {}
+    for name, unpackdir, unpacked in this['layers']:
+        for kind, path, data in cache.files(unpackdir):
+            if kind in ('d', 'l') and kinds.setdefault(path, kind) != kind:
+                return path
+    return None
+
+
+def unmount(this):
+    '''Take down the overlay, if any, and let go of the layers.
+
+    The build and install directories stay behind in the upper layer, and
+    we point this at them there, ready for the artifact to be created.
+
+    '''
+    if this.get('mounted'):
+        call(['umount', this['sandbox']])
+        for directory in ['build', 'install', 'baserockdir', 'tmp']:
+            this[directory] = this['mounted'] + \
+                this[directory][len(this['sandbox']):]
+        this['mounted'] = None
+    for name, unpackdir, unpacked in this.get('layers', []):
+        unpacked.__exit__(None, None, None)
+    this['layers'] = []
+
+
+def snapshot_key(defs, this, dependencies):
+    '''Return the name for a snapshot of this staged with dependencies.'''
+    staging = [this.get('build-mode', 'staging')]
+    staging += [cache.cache_key(defs, it) for it in dependencies]
+    return hashlib.sha256(json.dumps(staging)).hexdigest()
+
+
+def restore(this, key):
+    '''Stage this from the snapshot called key, if there is one.'''
+    snapshot = os.path.join(app.config['tmp'], 'snapshots', key)
+    if not os.path.isdir(snapshot):
+        return False
+    utils.hardlink_all_files(snapshot, this['sandbox'], cache.files(snapshot))
+    app.log(this, 'Staged dependencies from snapshot', key)
+    return True
+
+
+def snapshot(this, key):
+    '''Save the staged sandbox of this as the snapshot called key.'''
+    snapshot = os.path.join(app.config['tmp'], 'snapshots', key)
+    if os.path.isdir(snapshot):
+        return
+    own = [os.path.basename(this['build']), os.path.basename(this['install'])]
+    tmpdir = tempfile.mkdtemp(dir=app.config['tmp'])
+    for entry in os.listdir(this['sandbox']):
+        if entry not in own:
+            utils.hardlink_all_files(os.path.join(this['sandbox'], entry),
+                                     os.path.join(tmpdir, entry))
+    try:
+        if not os.path.isdir(os.path.dirname(snapshot)):
+            os.makedirs(os.path.dirname(snapshot))
+        os.rename(tmpdir, snapshot)
+    except OSError:
+        # someone else saved the same snapshot first
+        app.remove_dir(tmpdir)
+    # save its manifest, so restoring doesn't have to walk it
+    cache.files(snapshot)
 
 
 def ldconfig(this):
@@ -141,10 +317,27 @@ def run_sandboxed(this, command, env=None, allow_parallel=False):
             network='isolated',
         )
 
-    argv = ['sh', '-c', command]
-
     cur_makeflags = env.get("MAKEFLAGS")
 
+    jobserver = None
+    if allow_parallel and '--jobserver-fds' in (cur_makeflags or ''):
+        # sandboxlib closes all our file descriptors, so we link the fifo
+        # into the sandbox and have the shell open it for make to inherit
+        jobserver = os.path.join(this['tmp'], '.jobserver')
+        fifo = '/tmp/.jobserver'
+        if this.get('build-mode') == 'bootstrap':
+            fifo = jobserver
+        try:
+            if not os.path.exists(jobserver):
+                os.link(app.config['jobserver-fifo'], jobserver)
+            command = 'exec 9<>%s\n%s' % (fifo, command)
+        except OSError:
+            # eg the sandbox is on overlayfs, so we can't link into it
+            jobserver = None
+            env['MAKEFLAGS'] = '-j%s' % app.jobs()
+
+    argv = ['sh', '-c', command]
+
     # Adjust config for what the backend is capable of. The user will be warned
     # about any changes made.
     config = executor.degrade_config_for_capabilities(config, warn=False)
@@ -169,6 +362,8 @@ def run_sandboxed(this, command, env=None, allow_parallel=False):
     finally:
         if cur_makeflags is not None:
             env['MAKEFLAGS'] = cur_makeflags
+        if jobserver and os.path.exists(jobserver):
+            os.remove(jobserver)
 
 
 def run_logged(this, cmd_list):
@@ -285,8 +480,12 @@ def env_vars_for_build(defs, this):
 
     env['PATH'] = ':'.join(path)
     env['PREFIX'] = this.get('prefix') or '/usr'
-    env['MAKEFLAGS'] = '-j%s' % (this.get('max-jobs') or
-                                 app.config['max-jobs'])
+    if app.config.get('jobserver-fifo') and not this.get('max-jobs'):
+        # run_sandboxed() opens the jobserver fifo as fd 9
+        env['MAKEFLAGS'] = '-j --jobserver-fds=9,9'
+    else:
+        env['MAKEFLAGS'] = '-j%s' % (this.get('max-jobs') or
+                                     app.config['max-jobs'])
     env['TERM'] = 'dumb'
     env['SHELL'] = '/bin/sh'
     env['USER'] = env['USERNAME'] = env['LOGNAME'] = 'tomjon'
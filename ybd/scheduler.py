@@ -0,0 +1,219 @@
+# Copyright (C) 2016  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# =*= License: GPL-2 =*=
+
+'''Build the components of a target on several workers at once.
+
+Rather than running several complete copies of ybd which race each other
+for the same components, a single scheduler works out which components
+are ready to build (all of their inputs are cached) and hands them out to
+a pool of forked workers, each of which runs compose() for one component.
+
+When more components are ready than there are workers, the ones on the
+longest remaining path to the target go first, using how long each
+component took to build last time. That way the long chains (compilers,
+libc, the big strata) start early and don't leave most of the workers
+idle at the end.
+
+If another ybd has claimed a component, its worker gives up straight away
+and a watcher process waits for the claim to be released, so the scheduler
+is woken when the artifact lands and meanwhile gets on with other work.
+
+'''
+
+import os
+import signal
+
+import app
+from assembly import compose, wait, RetryException
+from cache import cache_key, get_cache, get_durations
+
+# exit status for a worker which found its component locked by another ybd
+RETRY = 75
+
+
+def inputs(defs, component):
+    '''Return the paths of everything compose() needs cached for component.'''
+    result = component.get('build-depends', []) + component.get('contents', [])
+
+    def add_systems_recursively(system):
+        result.append(system.get('path', 'BROKEN'))
+        for subsystem in system.get('subsystems', []):
+            add_systems_recursively(subsystem)
+
+    for system in component.get('systems', []):
+        add_systems_recursively(system)
+
+    return [defs.get(it)['path'] for it in result]
+
+
+def priorities(defs, components, durations):
+    '''Return the expected build time of each of the components, and the
+    expected time from the start of each component to the end.
+
+    The latter is the length of the longest chain of builds from the component
+    (inclusive) to the last of the components. Components with no history
+    are assumed to take the average of the ones which have some.
+
+    '''
+    names = dict((c['path'], c['name'].replace('/', '-'))
+                 for c in components)
+    known = [durations[name] for name in names.values() if name in durations]
+    default = sum(known) / len(known) if known else 60
+
+    paths = set(c['path'] for c in components)
+    dependents = dict((path, []) for path in paths)
+    for component in components:
+        for it in inputs(defs, component):
+            if it in paths:
+                dependents[it].append(component['path'])
+
+    duration = dict((path, durations.get(name, default))
+                    for path, name in names.items())
+    result = {}
+    for component in reversed(components):
+        after = [result[it] for it in dependents[component['path']]]
+        result[component['path']] = duration[component['path']] + \
+            max(after or [0])
+    return duration, result
+
+
+def eta(components, durations, priority, workers):
+    '''Return a rough hh:mm:ss estimate of the time to build components.
+
+    We can't finish sooner than the longest chain of builds still to run, nor
+    sooner than the total time of all of them shared across the workers.
+
+    '''
+    seconds = 0
+    if components:
+        total = sum(durations[c['path']] for c in components)
+        seconds = max(max(priority[c['path']] for c in components),
+                      total / float(workers))
+    hours, remainder = divmod(int(seconds), 60 * 60)
+    minutes, seconds = divmod(remainder, 60)
+    return '%02d:%02d:%02d' % (hours, minutes, seconds)
+
+
+def build(defs, target):
+    '''Build everything needed for target, on 'instances' workers.'''
+    components = defs.components(target)
+    done = set()
+    pending = []
+    for component in components:
+        if cache_key(defs, component) is False or \
+                component.get('kind') == 'cluster' or \
+                get_cache(defs, component):
+            done.add(component['path'])
+        else:
+            pending.append(component)
+
+    workers = app.config.get('instances', 1)
+    duration, priority = priorities(defs, pending, get_durations())
+    app.log('SCHEDULER', 'Building %s components on %s workers, ETA' %
+            (len(pending), workers), eta(pending, duration, priority, workers))
+
+    running = {}
+    watching = {}
+    failed = False
+    while pending or running or watching:
+        if not failed:
+            ready = [c for c in pending
+                     if all(it in done for it in inputs(defs, c))]
+            ready.sort(key=lambda c: priority[c['path']], reverse=True)
+            while ready and len(running) < workers:
+                component = ready.pop(0)
+                pending.remove(component)
+                busy = [slot for c, slot in running.values()]
+                slot = min(set(range(1, workers + 1)) - set(busy))
+                running[start(defs, component, slot)] = (component, slot)
+
+        if not running:
+            if failed or not (pending or watching):
+                break
+            if not watching:
+                app.log('SCHEDULER', 'ERROR: nothing can be built from',
+                        [c['name'] for c in pending])
+                failed = True
+                break
+
+        pid, status = os.wait()
+        if pid in watching:
+            component = watching.pop(pid)
+            if get_cache(defs, component):
+                done.add(component['path'])
+            else:
+                # the other ybd didn't finish it, so have a go ourselves
+                pending.append(component)
+            continue
+
+        if pid not in running:
+            # some other child, eg the background cull
+            continue
+        component, slot = running.pop(pid)
+        app.config['counter'].set_current('', slot)
+        status = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+        if status == 0 and get_cache(defs, component):
+            done.add(component['path'])
+            left = pending + [c for c, slot in running.values()] + \
+                watching.values()
+            app.log('SCHEDULER', '%s components left, ETA' % len(left),
+                    eta(left, duration, priority, workers))
+        elif status == RETRY:
+            watching[watch(defs, component)] = component
+        else:
+            # a worker which exits cleanly without an artifact failed too
+            app.log(component, 'ERROR: build failed, waiting for',
+                    '%s other builds' % len(running))
+            failed = True
+
+    for pid in watching:
+        os.kill(pid, signal.SIGTERM)
+
+    if failed:
+        app.exit('SCHEDULER', 'ERROR: failed to build', target['name'])
+
+
+def start(defs, component, slot):
+    '''Fork a worker to compose component, and return its pid.'''
+    pid = os.fork()
+    if pid:
+        return pid
+
+    app.config['fork'] = slot
+    app.config['sandboxes'] = []
+    status = 0
+    try:
+        compose(defs, component)
+    except RetryException:
+        status = RETRY
+    except:
+        import traceback
+        traceback.print_exc()
+        app.log(component, 'Exiting: uncaught exception')
+        status = 1
+    os._exit(status)
+
+
+def watch(defs, component):
+    '''Fork a process which exits when the claim on component is released.'''
+    pid = os.fork()
+    if pid:
+        return pid
+
+    try:
+        wait(defs, component)
+    finally:
+        os._exit(0)
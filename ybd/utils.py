@@ -14,13 +14,24 @@
 #
 # =*= License: GPL-2 =*=
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
 import gzip
+import hashlib
 import tarfile
 import contextlib
 import os
 import shutil
 import stat
+import struct
 import calendar
+import threading
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE, call
 
 import app
 
@@ -45,31 +56,230 @@ def set_mtime_recursively(root, set_time=default_magic_timestamp):
         os.utime(dirname, (set_time, set_time))
 
 
-def copy_all_files(srcpath, destpath):
+def directory_size(root):
+    '''Return the total size in bytes of all the files in a directory tree.'''
+
+    size = 0
+    for dirname, subdirs, basenames in os.walk(root):
+        for basename in basenames:
+            size += os.lstat(os.path.join(dirname, basename)).st_size
+    return size
+
+
+def hash_file(path, blocksize=1024*1024):
+    '''Return the sha256 hex digest of the contents of a file.'''
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def copy_all_files(srcpath, destpath, entries=None):
     '''Copy every file in the source path to the destination.
 
+    If entries (from file_list()) is given, it is used instead of walking
+    the source path. Returns the number of entries staged, if known.
+
+    Each file is copied the quickest way that works: a reflink (sharing
+    the data, on btrfs or xfs for example), then copy_file_range or
+    sendfile (copying in the kernel), and only then by reading and writing
+    it here. A method which turns out not to be supported isn't tried again
+    for the rest of the copy. With log-verbose we log how many files went
+    each way.
+
     If an exception is raised, the staging-area is indeterminate.
 
     '''
+    methods = [m for m in copiers if m not in unsupported_copiers]
+    used = {}
+    lock = threading.Lock()
 
     def _copyfun(inpath, outpath):
-        with open(inpath, "r") as infh:
-            with open(outpath, "w") as outfh:
-                shutil.copyfileobj(infh, outfh, 1024*1024*4)
+        infd = os.open(inpath, os.O_RDONLY)
+        try:
+            # never write through whatever is already there (eg a symlink
+            # staged by an earlier dependency), let the caller replace it
+            outfd = os.open(outpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            try:
+                size = os.fstat(infd).st_size
+                for method in [m for m in methods]:
+                    try:
+                        copiers[method](infd, outfd, size)
+                        break
+                    except (IOError, OSError) as e:
+                        if method == 'userspace' or \
+                                e.errno not in unsupported_errors:
+                            raise
+                        with lock:
+                            if method in methods:
+                                methods.remove(method)
+                        os.lseek(infd, 0, os.SEEK_SET)
+                        os.lseek(outfd, 0, os.SEEK_SET)
+                        os.ftruncate(outfd, 0)
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
         shutil.copystat(inpath, outpath)
+        with lock:
+            used[method] = used.get(method, 0) + 1
 
-    _process_tree(srcpath, destpath, _copyfun)
+    if entries is not None:
+        count = _process_entries(srcpath, destpath, entries, _copyfun)
+    else:
+        count = _process_tree(srcpath, destpath, _copyfun)
+    if app.config.get('log-verbose'):
+        app.log('COPY', 'Copied files from %s using' % srcpath, used)
+    return count
+
+
+def _reflink(infd, outfd, size):
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+
+def _copy_file_range(infd, outfd, size):
+    _kernel_copy(lambda count: _libc.copy_file_range(
+        infd, None, outfd, None, count, 0), size)
+
+
+def _sendfile(infd, outfd, size):
+    _kernel_copy(lambda count: _libc.sendfile(outfd, infd, None, count), size)
+
+
+def _kernel_copy(copy, size):
+    while size > 0:
+        copied = copy(min(size, 1 << 30))
+        if copied < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if copied == 0:
+            break
+        size -= copied
+
+
+def _userspace(infd, outfd, size):
+    while True:
+        data = os.read(infd, 1024*1024*4)
+        if not data:
+            break
+        while data:
+            data = data[os.write(outfd, data):]
+
+
+# the ioctl to share the data of one file with another (linux/fs.h)
+FICLONE = 0x40049409
+
+# errors which mean a copy method doesn't work here, rather than a problem
+unsupported_errors = [errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL,
+                      errno.ENOSYS, errno.ENOTTY, errno.EBADF]
+
+copiers = collections.OrderedDict([('reflink', _reflink),
+                                   ('copy_file_range', _copy_file_range),
+                                   ('sendfile', _sendfile),
+                                   ('userspace', _userspace)])
+
+# copy_file_range and sendfile aren't in python 2's os module, so we call
+# them from libc (copy_file_range needs glibc 2.27 or later)
+unsupported_copiers = []
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.sendfile.restype = ctypes.c_ssize_t
+    _libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                               ctypes.c_size_t]
+    if hasattr(_libc, 'copy_file_range'):
+        _libc.copy_file_range.restype = ctypes.c_ssize_t
+        _libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                          ctypes.c_int, ctypes.c_void_p,
+                                          ctypes.c_size_t, ctypes.c_uint]
+    else:
+        unsupported_copiers = ['copy_file_range']
+except (OSError, TypeError, AttributeError):
+    unsupported_copiers = ['copy_file_range', 'sendfile']
 
 
-def hardlink_all_files(srcpath, destpath):
+def hardlink_all_files(srcpath, destpath, entries=None):
     '''Hardlink every file in the path to the staging-area
 
+    If entries (from file_list()) is given, it is used instead of walking
+    the source path. Returns the number of entries staged, if known.
+
     If an exception is raised, the staging-area is indeterminate.
 
     '''
+    if entries is not None:
+        return _process_entries(srcpath, destpath, entries, os.link)
     _process_tree(srcpath, destpath, os.link)
 
 
+def file_list(root):
+    '''Return the entries for staging everything under root, by walking it.
+
+    See staging_list() for the entries.
+
+    '''
+    return staging_list(tree_manifest(root))
+
+
+def _process_entries(srcpath, destpath, entries, actionfunc, batch=1000):
+    '''Stage entries from srcpath to destpath, like _process_tree().
+
+    All of the directories are created first, in one pass. Then everything
+    else is done in batches on a pool of threads, since the time goes on
+    system calls (which don't hold the GIL) rather than on python. The
+    number of threads is set by 'staging-workers'.
+
+    '''
+    if not os.path.lexists(destpath):
+        os.makedirs(destpath)
+    for kind, path, data in entries:
+        if kind == 'd':
+            target = os.path.join(destpath, path)
+            try:
+                os.mkdir(target)
+            except OSError:
+                if not os.path.isdir(target):
+                    raise IOError('Destination not a directory. source has '
+                                  '%s destination has %s' %
+                                  (os.path.join(srcpath, path), target))
+
+    def process(batch):
+        for kind, path, data in batch:
+            target = os.path.join(destpath, path)
+            try:
+                _process_entry(srcpath, target, kind, path, data, actionfunc)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                # staged already, by an earlier dependency
+                os.remove(target)
+                _process_entry(srcpath, target, kind, path, data, actionfunc)
+
+    others = [entry for entry in entries if entry[0] != 'd']
+    batches = [others[i:i + batch] for i in range(0, len(others), batch)]
+    if len(batches) > 1:
+        pool = ThreadPool(min(len(batches),
+                              app.config.get('staging-workers', 8)))
+        try:
+            pool.map(process, batches)
+        finally:
+            pool.close()
+    else:
+        map(process, batches)
+    return len(entries)
+
+
+def _process_entry(srcpath, target, kind, path, data, actionfunc):
+    if kind == 'f':
+        actionfunc(os.path.join(srcpath, path), target)
+    elif kind == 'l':
+        os.symlink(data, target)
+    elif kind == 'c':
+        os.mknod(target, data[0], data[1])
+        os.chmod(target, data[0])
+
+
 def _process_tree(srcpath, destpath, actionfunc):
     file_stat = os.lstat(srcpath)
     mode = file_stat.st_mode
@@ -207,58 +417,283 @@ def _process_list(srcdir, destdir, filelist, actionfunc):
                           ' type.' % srcpath)
 
 
-def make_deterministic_gztar_archive(base_name, root_dir, time=1321009871.0):
-    '''Make a gzipped tar archive of contents of 'root_dir'.
+# Compressors which can use all of the cores, and still produce the same
+# output whatever the number of threads. 'gzip' (python, on its own thread)
+# and 'none' are handled separately.
+compressors = {
+    'pigz': ['pigz', '--no-name', '--to-stdout', '-'],
+    'zstd': ['zstd', '-T0', '-q', '-c', '-'],
+}
+
+# Magic numbers at the start of each kind of compressed file
+magic = [('\x1f\x8b', 'gzip'), ('\x28\xb5\x2f\xfd', 'zstd')]
+
+
+def make_deterministic_archive(base_name, root_dir, codec='gzip',
+                               time=default_magic_timestamp, trailer=None):
+    '''Make an archive of 'root_dir' at 'base_name', compressed with codec.
+
+    This is done in a single sorted walk of the tree, so the ordering of the
+    files in the archive is always the same. Rather than setting the mtime
+    of every file on disk, we set a fixed timestamp in the tar headers (and
+    the gzip header). Compression happens on a separate thread or process,
+    so it overlaps with reading the files.
+
+    The codec can be 'gzip', 'pigz', 'zstd' or 'none'. If the tool for a
+    multi-threaded codec is not available we fall back to 'gzip'.
 
-    This function takes extra steps to ensure the output is deterministic,
-    compared to shutil.make_archive(). First, it sorts the results of
-    os.listdir() to ensure the ordering of the files in the archive is the
-    same. Second, it sets a fixed timestamp and filename in the gzip header.
+    As we go we build a manifest, a list of (path, type, mode, size, sha256,
+    link target, rdev) for each entry in the archive. If a trailer (path, function) is given,
+    the file at path is skipped during the walk. Instead function(manifest)
+    is called at the end, and the text it returns is written to path in
+    root_dir and added as the last entry in the archive (and manifest).
 
-    As well as fixing https://bugs.python.org/issue24465, to make this function
-    redundant we would need to patch shutil.make_archive() so we could manually
-    set the timestamp and filename set in the gzip file header.
+    Returns the codec which was actually used, and the manifest.
 
     '''
-    # It's hard to implement this function by monkeypatching
-    # shutil.make_archive() because of the way the tarfile module includes the
-    # filename of the tarfile in the gzip header. So we have to reimplement
-    # shutil.make_archive().
+    if codec in compressors and not find_executable(compressors[codec][0]):
+        app.log('ARCHIVE', 'WARNING: %s not found, using gzip for' % codec,
+                base_name)
+        codec = 'gzip'
+    if codec not in compressors and codec not in ['gzip', 'none']:
+        raise IOError('Unknown compression %s for %s' % (codec, base_name))
+
+    manifest = []
+    skip = os.path.join('.', trailer[0]) if trailer else None
+    with open(base_name, 'wb') as f:
+        compressor = thread = None
+        errors = []
+        if codec == 'gzip':
+            read_fd, write_fd = os.pipe()
+
+            def compress():
+                try:
+                    with os.fdopen(read_fd, 'rb') as pipe:
+                        with gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                           mtime=time) as f_gzip:
+                            shutil.copyfileobj(pipe, f_gzip, 1024*1024)
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=compress)
+            thread.start()
+            stream = os.fdopen(write_fd, 'wb')
+        elif codec in compressors:
+            compressor = Popen(compressors[codec], stdin=PIPE, stdout=f)
+            stream = compressor.stdin
+        else:
+            stream = f
+
+        try:
+            with tarfile.open(mode='w|', fileobj=stream) as f_tar:
+                _add_directory_to_tarfile(f_tar, root_dir, '.', time,
+                                          manifest, skip)
+                if trailer:
+                    path = trailer[0]
+                    with open(os.path.join(root_dir, path), 'w') as t:
+                        t.write(trailer[1](manifest))
+                    info = f_tar.gettarinfo(os.path.join(root_dir, path),
+                                            os.path.join('.', path))
+                    info.mtime = time
+                    with open(os.path.join(root_dir, path), 'rb') as t:
+                        reader = _HashingReader(t)
+                        f_tar.addfile(info, reader)
+                    manifest.append(_entry(info, reader.sha.hexdigest()))
+        finally:
+            if stream is not f:
+                stream.close()
+            if thread:
+                thread.join()
+            if compressor and compressor.wait():
+                errors.append('%s failed' % codec)
+
+    if errors:
+        raise IOError('Problem compressing %s: %s' % (root_dir, errors[0]))
+
+    return codec, manifest
+
+
+class _HashingReader(object):
+    '''Wrap a file so that we get the sha256 of everything read from it.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+
+def _add_directory_to_tarfile(f_tar, dir_name, dir_arcname, time, manifest,
+                              skip=None):
+    for filename in sorted(os.listdir(dir_name)):
+        name = os.path.join(dir_name, filename)
+        arcname = os.path.join(dir_arcname, filename)
+        if arcname == skip:
+            continue
+
+        info = f_tar.gettarinfo(name, arcname)
+        info.mtime = time
+        digest = None
+        if info.isreg():
+            with open(name, 'rb') as f:
+                reader = _HashingReader(f)
+                f_tar.addfile(info, reader)
+            digest = reader.sha.hexdigest()
+        else:
+            f_tar.addfile(info)
+        manifest.append(_entry(info, digest))
+
+        if info.isdir():
+            _add_directory_to_tarfile(f_tar, name, arcname, time, manifest,
+                                      skip)
 
-    def add_directory_to_tarfile(f_tar, dir_name, dir_arcname):
-        for filename in sorted(os.listdir(dir_name)):
-            name = os.path.join(dir_name, filename)
-            arcname = os.path.join(dir_arcname, filename)
 
-            f_tar.add(name=name, arcname=arcname, recursive=False)
+kinds = ['file', 'dir', 'sym', 'lnk', 'chr', 'blk', 'fifo', 'other']
 
-            if os.path.isdir(name) and not os.path.islink(name):
-                add_directory_to_tarfile(f_tar, name, arcname)
+# manifest record: kind, mode, size, sha256 (zeros if none), rdev,
+# path length, link target length
+record = struct.Struct('!BIQ32sQHH')
 
-    with open(base_name + '.tar.gz', 'wb') as f:
-        gzip_context = gzip.GzipFile(
-            filename='', mode='wb', fileobj=f, mtime=time)
-        with gzip_context as f_gzip:
-            with tarfile.TarFile(mode='w', fileobj=f_gzip) as f_tar:
-                add_directory_to_tarfile(f_tar, root_dir, '.')
 
+def _kind(info):
+    for kind in kinds[:-1]:
+        if getattr(info, 'is' + kind)():
+            return kind
+    return 'other'
 
-def make_deterministic_tar_archive(base_name, root_dir):
-    '''Make a tar archive of contents of 'root_dir'.
 
-    This function uses monkeypatching to make shutil.make_archive() create
-    a deterministic tarfile.
+def _entry(info, digest):
+    '''Return the manifest entry for a tar member.'''
+    rdev = 0
+    if info.ischr() or info.isblk():
+        rdev = os.makedev(info.devmajor, info.devminor)
+    return (info.name, _kind(info), info.mode, info.size, digest,
+            info.linkname, rdev)
 
-    https://bugs.python.org/issue24465 will make this function redundant.
+
+def write_manifest(path, manifest):
+    '''Save a manifest from make_deterministic_archive() in binary form.
+
+    Each entry is a fixed size record followed by the path and the link
+    target, so the whole thing is small and quick to read back.
 
     '''
-    real_listdir = os.listdir
+    with open(path, 'wb') as f:
+        f.write('YBDM\x02')
+        for name, kind, mode, size, digest, linkname, rdev in manifest:
+            digest = digest.decode('hex') if digest else '\0' * 32
+            f.write(record.pack(kinds.index(kind), mode, size, digest, rdev,
+                                len(name), len(linkname)))
+            f.write(name)
+            f.write(linkname)
+
+
+def read_manifest(path):
+    '''Return the manifest saved at path by write_manifest().'''
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith('YBDM\x02'):
+        raise IOError('%s is not a manifest' % path)
+    manifest = []
+    offset = 5
+    while offset < len(data):
+        kind, mode, size, digest, rdev, length, linklength = \
+            record.unpack_from(data, offset)
+        offset += record.size
+        name = data[offset:offset + length]
+        offset += length
+        linkname = data[offset:offset + linklength]
+        offset += linklength
+        digest = digest.encode('hex') if digest != '\0' * 32 else None
+        manifest.append((name, kinds[kind], mode, size, digest, linkname,
+                         rdev))
+    return manifest
+
+
+def tree_manifest(root):
+    '''Return a manifest for everything under root, parents before children.
+
+    This is like the manifest from make_deterministic_archive(), but without
+    the sha256s, for trees which weren't archived (eg staging snapshots).
+
+    '''
+    manifest = []
+    for dirname, subdirs, basenames in os.walk(root):
+        for basename in sorted(subdirs + basenames):
+            path = os.path.join(dirname, basename)
+            info = os.lstat(path)
+            name = os.path.join('.', os.path.relpath(path, root))
+            linkname = ''
+            if stat.S_ISDIR(info.st_mode):
+                kind = 'dir'
+            elif stat.S_ISLNK(info.st_mode):
+                kind = 'sym'
+                linkname = os.readlink(path)
+            elif stat.S_ISREG(info.st_mode):
+                kind = 'file'
+            elif stat.S_ISCHR(info.st_mode):
+                kind = 'chr'
+            elif stat.S_ISBLK(info.st_mode):
+                kind = 'blk'
+            else:
+                kind = 'other'
+            manifest.append((name, kind, info.st_mode, info.st_size, None,
+                             linkname, info.st_rdev))
+    return manifest
+
+
+def staging_list(manifest):
+    '''Return the entries for staging a tree, from its manifest.
+
+    Each entry is (kind, path, data) where kind is 'd' for a directory, 'f'
+    for a file, 'l' for a symlink (data is its target) or 'c' for a device
+    (data is its mode and rdev).
+
+    '''
+    entries = []
+    for name, kind, mode, size, digest, linkname, rdev in manifest:
+        path = os.path.normpath(name)
+        if kind == 'dir':
+            entries.append(('d', path, None))
+        elif kind == 'sym':
+            entries.append(('l', path, linkname))
+        elif kind in ('file', 'lnk'):
+            # hardlinks in the archive are just files in the tree
+            entries.append(('f', path, None))
+        elif kind in ('chr', 'blk'):
+            ifmt = stat.S_IFCHR if kind == 'chr' else stat.S_IFBLK
+            entries.append(('c', path, (mode | ifmt, rdev)))
+        else:
+            raise IOError('Cannot extract %s into staging-area. '
+                          'Unsupported type.' % name)
+    return entries
+
+
+def detect_codec(path):
+    '''Return the codec that the archive at path was compressed with.'''
+
+    with open(path, 'rb') as f:
+        header = f.read(4)
+    for prefix, codec in magic:
+        if header.startswith(prefix):
+            return codec
+    return 'none'
+
 
-    def stable_listdir(path):
-        return sorted(real_listdir(path))
+def unpack_archive(path, directory):
+    '''Unpack an archive made by make_deterministic_archive(), whatever the
+    codec. Returns True on success.'''
 
-    with monkeypatch(os, 'listdir', stable_listdir):
-        shutil.make_archive(base_name, 'tar', root_dir)
+    args = ['tar', 'xf', path, '--directory', directory]
+    codec = detect_codec(path)
+    if codec == 'zstd':
+        args += ['--use-compress-program', 'zstd -T0']
+    elif codec == 'gzip' and find_executable('pigz'):
+        args += ['--use-compress-program', 'pigz']
+    return call(args) == 0
 
 
 def _find_extensions(paths):